@@ -1,7 +1,13 @@
-import random
 from math import sqrt
+import numpy as np
+from scipy.sparse import issparse
 from PIL import Image, ImageDraw
 
+from hierarchical import linkage
+from kmeans import kmeans, bestmatches
+from scaling import mds
+from wordmatrix import wordmatrix, asrows
+
 class bicluster:
     def __init__(self, vec, left=None, right=None, distance=0.0, id=None):
         self.left = left
@@ -87,100 +93,60 @@ def tanimoto(v1, v2):
     # so we return 1 - coefficient instead
     return 1.0 - coefficient
 
-def hcluster(rows, distance = pearson):
-    distances = {}
-    current_clust_id = -1
+def average(u, v):
+    # Average of two vectors, kept sparse or as a list if they were
+    if issparse(u): return (u + v) / 2.0
 
-    # Clusters are initially just the rows
-    clusters = [bicluster(rows[i], id=i) for i in range(len(rows))]
+    merged = (np.asarray(u, dtype=float) + np.asarray(v, dtype=float)) / 2.0
+    if isinstance(u, list): return merged.tolist()
+    return merged
 
-    while len(clusters) > 1:
-        lowestpair = (0, 1)
-        closest = distance(clusters[0].vec, clusters[1].vec)
+def hcluster(rows, distance=pearson, blocksize=256):
+    """
+    Cluster the rows hierarchically, repeatedly merging the closest two
+    clusters into one whose vector is the average of theirs, and return
+    the root bicluster. rows may also be a wordmatrix or a sparse matrix,
+    whose clusters then have sparse vectors.
+    """
+    if isinstance(rows, wordmatrix) or issparse(rows): rows = asrows(rows)
 
-        # loop through every pair looking for the smallest distance
-        for i in range(len(clusters)):
-            for j in range(i+1, len(clusters)):
-                # distances is the cache of the distance calculations
-                if (clusters[i].id, clusters[j].id) not in distances:
-                    distances[clusters[i].id, clusters[j].id] = distance(clusters[i].vec, clusters[j].vec)
+    # Distances known to linkage by name are computed in bulk
+    metrics = {pearson: 'pearson', tanimoto: 'tanimoto'}
+    merges = linkage(rows, metrics.get(distance), distance, blocksize)
 
-                d = distances[(clusters[i].id, clusters[j].id)]
+    # Clusters are initially just the rows
+    clusters = dict((i, bicluster(rows[i], id=i)) for i in range(len(merges) + 1))
 
-                if d < closest:
-                    closest = d
-                    lowestpair = (i,j)
+    for (k, (left, right, closest)) in enumerate(merges):
+        left = clusters.pop(left)
+        right = clusters.pop(right)
 
         # calculate the average of the two clusters
-        mergevec = [
-            (clusters[lowestpair[0]].vec[i] + clusters[lowestpair[1]].vec[i]) / 2.0
-            for i in range(len(clusters[0].vec))]
-
-        # create the new cluster
-        new_cluster = bicluster(mergevec, left = clusters[lowestpair[0]], right = clusters[lowestpair[1]],
-            distance = closest, id = current_clust_id)
+        mergevec = average(left.vec, right.vec)
 
         # cluster ids that weren't in the original set are negative
-        current_clust_id -= 1
-        del clusters[lowestpair[1]]
-        del clusters[lowestpair[0]]
-        clusters.append(new_cluster)
-
-    return clusters[0]
-
-def kcluster(rows, distance=pearson, k=4):
-    # Determine the minimum and maximum values for each point
-    # This is the min and max row value for each column
-    ranges = [(min([row[i] for row in rows]), max([row[i] for row in rows])) for i in range(len(rows[0]))]
-
-    # Create k randomly placed centroids that are within range of each row
-    clusters = [[random.random() * (ranges[i][1] - ranges[i][0]) + ranges[i][0] for i in range(len(rows[0]))] for j in range(k)]
-
-    lastmatches = None
-
-    for t in range(100):
-        # 100 is an arbitrarily chosen number of iterations we want to do
-        # if we are not able to attain the desired number of clusters soon
-        # enough
-        print 'Iteration %d' % t
-        bestmatches = [[] for i in range(k)]
-
-        # Find which centroid is the closest for each row
-        for j in range(len(rows)):
-            row = rows[j]
-            bestmatch = 0
-            best_distance = distance(clusters[bestmatch], row)
-
-            for i in range(k):
-                d = distance(clusters[i], row)
-
-                if d < best_distance:
-                    bestmatch = i
-                    best_distance = d
-
-            bestmatches[bestmatch].append(j)
-
-        # If the results are the same as the last time, this is complete
-        if bestmatches == lastmatches:
-            break
-
-        lastmatches = bestmatches
-
-        # Move the centroids to the average of their members
-        for i in range(k):
-            avgs = [0.0] * len(rows[0])
+        clusters[-k - 1] = bicluster(mergevec, left=left, right=right, distance=closest, id=-k - 1)
 
-            if len(bestmatches[i]) > 0:
-                for rowid in bestmatches[i]:
-                    for m in range(len(rows[rowid])):
-                        avgs[m] += rows[rowid][m]
+    return clusters.values()[0]
 
-                    for j in range (len(avgs)):
-                        avgs[j] /= len(bestmatches[i])
-
-                clusters[i] = avgs
+def kcluster(rows, distance=pearson, k=4, iterations=100, tol=1e-4, batchsize=None,
+             restarts=1, processes=None, seed=None):
+    """
+    Cluster the rows into k groups with k-means and return the row numbers
+    in each. Centroids are seeded with k-means++, and each run stops once
+    the assignments stop changing, after iterations passes, or once no
+    centroid moves by more than tol times the spread of the data.
+
+    restarts runs are made across a pool of processes and the one with
+    the rows closest to their centroids is kept. With batchsize, each run
+    is mini-batch k-means on random batches of that many rows. rows may
+    also be a wordmatrix or a sparse matrix.
+    """
+    metrics = {pearson: 'pearson', tanimoto: 'tanimoto'}
+    (closest, centroids) = kmeans(rows, k, metrics.get(distance), distance, iterations, tol, batchsize,
+                                  restarts, processes, seed)
 
-    return bestmatches
+    return bestmatches(closest, k)
 
 
 def print_cluster(cluster, labels=None, n=0):
@@ -262,56 +228,18 @@ def draw_node(draw, cluster, x, y, scaling, labels):
         # If this is an endpoint, draw the item label
         draw.text((x+5, y-7), labels[cluster.id], (0, 0, 0))
 
-def scaledown(data, distance=pearson, rate=0.01):
-    n = len(data)
-
-    # The real distances between every pair of items
-    realdist = [[distance(data[i], data[j]) for j in range(n)] for i in range(0,n)]
-
-    outersum = 0.0
-
-    # Randomly initialize the starting points of the locations in 2D
-    loc = [[random.random(), random.random()] for i in range(n)]
-    fakedist = [[0.0 for j in range(n)] for i in range(n)]
-
-    lasterror = None
-    for m in range(0, 1000):
-        # Find projected distances
-        for i in range(n):
-            for j in range(n):
-                fakedist[i][j] = sqrt(sum([pow(loc[i][x] - loc[j][x], 2) for x in range(len(loc[i]))]))
-
-        # Move points
-        grad = [[0.0, 0.0] for i in range(n)]
-
-        totalerror = 0
-        for k in range(n):
-            for j in range(n):
-                if j == k: continue
-
-                # The error is percent difference between the distances
-                errorterm = (fakedist[j][k] - realdist[j][k])/realdist[j][k]
-
-                # Each point needs to be moved away from or towards the other
-                # point in proportion to how much error it has
-                grad[k][0] += ((loc[k][0] - loc[j][0])/fakedist[j][k]) * errorterm
-                grad[k][1] += ((loc[k][1] - loc[j][1])/fakedist[j][k]) * errorterm
-
-                # Keep track of the total error
-                totalerror += abs(errorterm)
-
-        print totalerror
-
-        # If the answer got worse by moving the points, we are done
-        if lasterror and lasterror < totalerror: break
-        lasterror = totalerror
-
-        # Move each of the points by learning rate times the gradient
-        for k in range(n):
-            loc[k][0] -= rate * grad[k][0]
-            loc[k][1] -= rate * grad[k][1]
+def scaledown(data, distance=pearson, rate=0.01, dims=2, iterations=1000, tol=1e-4, landmarks=None, seed=None):
+    """
+    Multidimensional scaling: find positions in dims dimensions for the
+    rows whose distances are as close as possible to the real distances.
+    Stops once an iteration improves the error by less than tol of what it
+    was. With landmarks, only the distances to that many rows picked at
+    random are computed, for when n x n distances are too many.
+    """
+    metrics = {pearson: 'pearson', tanimoto: 'tanimoto'}
+    loc = mds(data, dims, metrics.get(distance), distance, rate, iterations, tol, landmarks, seed)
 
-    return loc
+    return loc.tolist()
 
 def draw2d(data, labels, jpeg='mds2d.jpg'):
     img = Image.new('RGB', (2000, 2000), (255, 255, 255))
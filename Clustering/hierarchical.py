@@ -0,0 +1,180 @@
+import numpy as np
+from wordmatrix import asrows, dense, dot, rowsquares, rowsums
+
+def condensed_size(n):
+    return n * (n - 1) // 2
+
+def row_positions(n, i):
+    """
+    Positions in a condensed distance matrix of the distances between i
+    and every j, or for an array of rows i an array with one row of
+    positions each. The condensed matrix holds the upper triangle row by
+    row; the position given for j == i itself is meaningless.
+    """
+    i = np.asarray(i)[..., np.newaxis]
+    j = np.arange(n)
+    lower = n * j - j * (j + 1) // 2 + i - j - 1
+    upper = n * i - i * (i + 1) // 2 + j - i - 1
+    return np.where(j < i, lower, upper)
+
+def pearson_block(data, sums, squares, start, stop):
+    # Pearson distances of rows start to stop against every row, the same
+    # sums as clusters.pearson
+    m = float(data.shape[1])
+    num = dot(data[start:stop], data) - np.outer(sums[start:stop], sums) / m
+    den = np.sqrt(np.outer(squares[start:stop], squares))
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(den == 0, 0.0, 1.0 - num / den)
+
+def tanimoto_block(nonzero, counts, start, stop):
+    # Tanimoto distances of rows start to stop against every row
+    both = np.dot(nonzero[start:stop], nonzero.T)
+    either = counts[start:stop, np.newaxis] + counts - both
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(either == 0, 0.0, 1.0 - both / either)
+
+def linkage(data, metric='pearson', distance=None, blocksize=256):
+    """
+    Merge the rows of data into a hierarchy the same way clusters.hcluster
+    does: repeatedly join the closest two clusters into one whose vector is
+    the average of theirs. Returns the merges in order as (left, right,
+    distance) tuples of cluster ids, with the rows numbered from 0 and the
+    n-th merged cluster numbered -n.
+
+    metric is 'pearson' or 'tanimoto', whose distances are computed for
+    blocks of rows at a time with matrix products. For pearson the
+    distances to a merged cluster come from the distances to its two halves
+    (the inner products of the centred vectors are linear in them), so a
+    merge costs one pass over a row. For tanimoto the merged cluster's row
+    is recomputed from its vector. With metric None, distance is called
+    for every pair.
+
+    data may be a list of rows, an array, a sparse matrix or a wordmatrix.
+    Pearson works on sparse data as it is; tanimoto and other distances
+    need the vectors of merged clusters, so they make a dense copy.
+
+    The distances are kept in a condensed matrix of n(n-1)/2 entries, and
+    each cluster remembers its nearest neighbour, so finding the closest
+    pair is a pass over n values instead of over every pair.
+    """
+    data = asrows(data)
+    n = data.shape[0]
+    dist = np.zeros(condensed_size(n))
+
+    # Nearest neighbour of each cluster and the distance to it
+    nearest = np.zeros(n, dtype=np.intp)
+    nearestdist = np.full(n, np.inf)
+
+    if metric == 'pearson':
+        # Sums and centred sums of squares of each row, the latter kept
+        # from going below 0 by rounding
+        sums = rowsums(data)
+        squares = np.maximum(rowsquares(data) - sums * sums / data.shape[1], 0)
+        block = lambda start, stop: pearson_block(data, sums, squares, start, stop)
+
+        # Only the lengths of the centred vectors are needed from here on
+        lengths = np.sqrt(squares)
+    elif metric == 'tanimoto':
+        vecs = dense(data).copy()
+        nonzero = (vecs != 0).astype(float)
+        counts = nonzero.sum(axis=1)
+        block = lambda start, stop: tanimoto_block(nonzero, counts, start, stop)
+    else:
+        vecs = dense(data).copy()
+        block = lambda start, stop: np.array([[distance(vecs[i], vecs[j]) for j in range(n)]
+                                              for i in range(start, stop)])
+
+    for start in range(0, n, blocksize):
+        stop = min(start + blocksize, n)
+        rows = block(start, stop)
+
+        for i in range(start, stop):
+            row = rows[i - start]
+            offset = n * i - i * (i + 1) // 2
+            dist[offset:offset + n - i - 1] = row[i + 1:]
+
+            row[i] = np.inf
+            nearest[i] = np.argmin(row)
+            nearestdist[i] = row[nearest[i]]
+
+    active = np.ones(n, dtype=bool)
+
+    # Cluster id held by each slot, and its place in hcluster's list of
+    # clusters, which decides which half of a merge is on the left
+    ids = list(range(n))
+    order = np.arange(n)
+
+    merges = []
+
+    for k in range(1, n):
+        a = int(np.argmin(nearestdist))
+        b = int(nearest[a])
+        closest = nearestdist[a]
+        if order[b] < order[a]: (a, b) = (b, a)
+
+        merges.append((ids[a], ids[b], float(closest)))
+
+        # The merged cluster takes a's slot
+        posa = row_positions(n, a)
+        posb = row_positions(n, b)
+
+        if metric == 'pearson':
+            rowa = (1.0 - dist[posa]) * lengths[a] * lengths
+            rowb = (1.0 - dist[posb]) * lengths[b] * lengths
+            between = (1.0 - closest) * lengths[a] * lengths[b]
+            merged = np.sqrt(max((lengths[a] ** 2 + 2 * between + lengths[b] ** 2) / 4.0, 0.0))
+
+            den = merged * lengths
+            with np.errstate(divide='ignore', invalid='ignore'):
+                row = np.where(den == 0, 0.0, 1.0 - (rowa + rowb) / 2.0 / den)
+            lengths[a] = merged
+        else:
+            vecs[a] = (vecs[a] + vecs[b]) / 2.0
+
+            if metric == 'tanimoto':
+                nonzero[a] = vecs[a] != 0
+                counts[a] = nonzero[a].sum()
+                row = tanimoto_block(nonzero, counts, a, a + 1)[0]
+            else:
+                row = np.zeros(n)
+                for j in active.nonzero()[0]:
+                    if j != a and j != b: row[j] = distance(vecs[a], vecs[j])
+
+        active[b] = False
+        ids[a] = -k
+        order[a] = n + k
+
+        others = active.copy()
+        others[a] = False
+        dist[posa[others]] = row[others]
+
+        row[~others] = np.inf
+        nearestdist[b] = np.inf
+
+        # Clusters whose nearest neighbour was one of the halves keep the
+        # merged cluster if it is no further away, otherwise they have to
+        # look again. The rest only need to check the merged cluster.
+        halves = others & ((nearest == a) | (nearest == b))
+        stale = halves & (row > nearestdist)
+        closer = (others & ~halves & (row < nearestdist)) | (halves & ~stale)
+        nearest[closer] = a
+        nearestdist[closer] = row[closer]
+
+        stale = stale.nonzero()[0]
+        for start in range(0, len(stale), blocksize):
+            rows = stale[start:start + blocksize]
+            other = dist[row_positions(n, rows)]
+            other[:, ~active] = np.inf
+            other[np.arange(len(rows)), rows] = np.inf
+            nearest[rows] = np.argmin(other, axis=1)
+            nearestdist[rows] = other[np.arange(len(rows)), nearest[rows]]
+
+        if others.any():
+            nearest[a] = np.argmin(row)
+            nearestdist[a] = row[nearest[a]]
+        else:
+            nearestdist[a] = np.inf
+
+    return merges
@@ -0,0 +1,218 @@
+from itertools import islice
+from multiprocessing import Pool
+import numpy as np
+from scipy.sparse import csr_matrix
+from wordmatrix import asrows, dense, dot, nonzeros, rowsquares, rowsums, std
+
+def pearson_distances(rows, centroids):
+    """
+    Pearson distance (1 - r, as clusters.pearson) between every row and
+    every centroid, with one row of distances per row. rows may be sparse.
+    """
+    m = float(rows.shape[1])
+    sums = rowsums(rows)
+    centroidsums = centroids.sum(axis=1)
+
+    num = dot(rows, centroids) - np.outer(sums, centroidsums) / m
+    squares = np.maximum(rowsquares(rows) - sums * sums / m, 0)
+    centroidsquares = np.maximum((centroids * centroids).sum(axis=1) - centroidsums * centroidsums / m, 0)
+    den = np.sqrt(np.outer(squares, centroidsquares))
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(den == 0, 0.0, 1.0 - num / den)
+
+def tanimoto_distances(rows, centroids):
+    rows = nonzeros(rows)
+    centroids = (centroids != 0).astype(float)
+
+    both = dot(rows, centroids)
+    either = rowsums(rows)[:, np.newaxis] + centroids.sum(axis=1) - both
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(either == 0, 0.0, 1.0 - both / either)
+
+def distances(rows, centroids, metric='pearson', distance=None):
+    if metric == 'pearson': return pearson_distances(rows, centroids)
+    if metric == 'tanimoto': return tanimoto_distances(rows, centroids)
+
+    return np.array([[distance(c, row) for c in centroids] for row in dense(rows)])
+
+def assign(rows, centroids, metric='pearson', distance=None):
+    """
+    Index of the closest centroid to each row and the distance to it
+    """
+    dist = distances(rows, centroids, metric, distance)
+    closest = np.argmin(dist, axis=1)
+    return closest, dist[np.arange(rows.shape[0]), closest]
+
+def seed_centroids(rows, k, rng, metric='pearson', distance=None):
+    """
+    Pick k rows as starting centroids with k-means++: each one is drawn
+    with probability proportional to the square of its distance from the
+    closest centroid picked so far, which spreads them out
+    """
+    n = rows.shape[0]
+    pick = rng.randint(n)
+    centroids = [dense(rows[pick:pick + 1])]
+    closest = distances(rows, centroids[0], metric, distance)[:, 0]
+
+    for i in range(1, k):
+        weights = closest ** 2
+        if weights.sum() > 0:
+            pick = rng.choice(n, p=weights / weights.sum())
+        else:
+            # Every row sits on a centroid already
+            pick = rng.randint(n)
+
+        centroids.append(dense(rows[pick:pick + 1]))
+        closest = np.minimum(closest, distances(rows, centroids[-1], metric, distance)[:, 0])
+
+    return np.concatenate(centroids).astype(float)
+
+def moved(old, new, scale, tol):
+    # Whether any centroid moved more than tol relative to scale
+    return np.sqrt(((new - old) ** 2).sum(axis=1)).max() > tol * scale
+
+def clustersums(rows, closest, k):
+    # Sum of the rows in each cluster, for dense or sparse rows
+    members = csr_matrix((np.ones(len(closest)), (closest, np.arange(len(closest)))),
+                         shape=(k, rows.shape[0]))
+    return dense(members.dot(rows))
+
+def lloyd(rows, k, rng, metric='pearson', distance=None, iterations=100, tol=1e-4):
+    """
+    One run of k-means over all the rows. Returns the cluster of each
+    row, the centroids and the total distance of the rows from their
+    centroids.
+    """
+    centroids = seed_centroids(rows, k, rng, metric, distance)
+    scale = std(rows)
+    closest = None
+
+    for t in range(iterations):
+        assigned = assign(rows, centroids, metric, distance)[0]
+
+        # If the results are the same as the last time, this is complete
+        if closest is not None and (assigned == closest).all(): break
+        closest = assigned
+
+        # Move the centroids to the average of their members; a centroid
+        # without members stays where it is
+        counts = np.bincount(closest, minlength=k)
+        sums = clustersums(rows, closest, k)
+        new = centroids.copy()
+        new[counts > 0] = sums[counts > 0] / counts[counts > 0][:, np.newaxis]
+
+        done = not moved(centroids, new, scale, tol)
+        centroids = new
+        if done: break
+
+    (closest, dist) = assign(rows, centroids, metric, distance)
+    return closest, centroids, dist.sum()
+
+def minibatch_step(centroids, counts, batch, metric='pearson', distance=None):
+    """
+    Move the centroids towards the rows of batch assigned to them. Each
+    centroid stays the running average of every row it was ever assigned,
+    counted in counts.
+    """
+    (closest, dist) = assign(batch, centroids, metric, distance)
+
+    added = np.bincount(closest, minlength=len(centroids))
+    sums = clustersums(batch, closest, len(centroids))
+
+    hit = added > 0
+    total = counts[hit] + added[hit]
+    centroids[hit] = (centroids[hit] * counts[hit][:, np.newaxis] + sums[hit]) / total[:, np.newaxis]
+    counts[hit] = total
+
+def minibatch(rows, k, batchsize=100, seed=None, metric='pearson', distance=None):
+    """
+    Mini-batch k-means over an iterable of rows, read batchsize rows at a
+    time, so the rows never have to be in memory together. Centroids are
+    seeded with k-means++ from the first batch, which needs at least k
+    rows. Returns the centroids; assign() gives each row its cluster.
+    """
+    rng = np.random.RandomState(seed)
+    rows = iter(rows)
+    centroids = None
+    counts = np.zeros(k)
+
+    while True:
+        batch = np.array(list(islice(rows, batchsize)), dtype=float)
+        if len(batch) == 0: break
+
+        if centroids is None: centroids = seed_centroids(batch, k, rng, metric, distance)
+        minibatch_step(centroids, counts, batch, metric, distance)
+
+    return centroids
+
+def minibatch_run(rows, k, rng, metric='pearson', distance=None, iterations=100, tol=1e-4, batchsize=100):
+    """
+    Mini-batch k-means over random batches of rows held in memory, stopping
+    when a batch no longer moves the centroids. Returns the same as lloyd.
+    """
+    centroids = seed_centroids(rows, k, rng, metric, distance)
+    counts = np.zeros(k)
+    scale = std(rows)
+
+    for t in range(iterations):
+        old = centroids.copy()
+        minibatch_step(centroids, counts, rows[rng.randint(rows.shape[0], size=batchsize)], metric, distance)
+        if not moved(old, centroids, scale, tol): break
+
+    (closest, dist) = assign(rows, centroids, metric, distance)
+    return closest, centroids, dist.sum()
+
+# State shared by the worker processes, set up by init_worker
+worker = {}
+
+def init_worker(rows, k, metric, distance, iterations, tol, batchsize):
+    worker['args'] = (rows, k, metric, distance, iterations, tol, batchsize)
+
+def run(seed):
+    (rows, k, metric, distance, iterations, tol, batchsize) = worker['args']
+    rng = np.random.RandomState(seed)
+
+    if batchsize is None:
+        return lloyd(rows, k, rng, metric, distance, iterations, tol)
+    return minibatch_run(rows, k, rng, metric, distance, iterations, tol, batchsize)
+
+def kmeans(rows, k=4, metric='pearson', distance=None, iterations=100, tol=1e-4, batchsize=None,
+           restarts=1, processes=None, seed=None):
+    """
+    Cluster rows into k clusters, keeping the best of restarts runs, i.e.
+    the one whose rows are closest in total to their centroids. The runs
+    are spread over a pool of processes.
+
+    With batchsize, each run is mini-batch k-means on random batches of
+    that many rows instead of full passes over the data. Returns the
+    cluster of each row and the centroids.
+
+    rows may be a list of rows, an array, a sparse matrix or a wordmatrix.
+    Sparse rows stay sparse except for the ones picked as seeds and, with
+    a distance function, for calling it.
+    """
+    rows = asrows(rows)
+    seeds = np.random.RandomState(seed).randint(2 ** 31 - 1, size=restarts)
+    args = (rows, k, metric, distance, iterations, tol, batchsize)
+
+    if restarts == 1 or processes == 1:
+        init_worker(*args)
+        results = [run(s) for s in seeds]
+    else:
+        pool = Pool(processes, initializer=init_worker, initargs=args)
+        try:
+            results = pool.map(run, seeds)
+        finally:
+            pool.close()
+            pool.join()
+
+    (closest, centroids, error) = min(results, key=lambda result: result[2])
+    return closest, centroids
+
+def bestmatches(closest, k):
+    """
+    The row numbers in each cluster, in the form kcluster returns
+    """
+    return [[int(j) for j in (closest == i).nonzero()[0]] for i in range(k)]
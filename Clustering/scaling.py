@@ -0,0 +1,113 @@
+import numpy as np
+from kmeans import distances
+from wordmatrix import asrows, dense
+
+def realdistances(data, columns, metric='pearson', distance=None, blocksize=256):
+    """
+    Distances between every row of data and the rows numbered in columns,
+    one row of distances per row of data. Entry [i, j] is the distance
+    from row columns[j] to row i, as clusters.scaledown orders them.
+    """
+    real = np.zeros((data.shape[0], len(columns)))
+
+    for start in range(0, len(columns), blocksize):
+        block = dense(data[columns[start:start + blocksize]])
+        real[:, start:start + blocksize] = distances(data, block, metric, distance)
+
+    return real
+
+def gradient(loc, targets, real, use):
+    """
+    Total error of the points in loc against the points in targets and the
+    gradient of each point in loc. The error of a pair is the percent
+    difference between their projected and their real distance; pairs not
+    in use, such as a point and itself, are left out.
+    """
+    # Projected distances, summed a dimension at a time so points on top of
+    # each other come out exactly 0
+    squares = np.zeros((len(loc), len(targets)))
+    for x in range(loc.shape[1]):
+        squares += (loc[:, x, np.newaxis] - targets[:, x]) ** 2
+    fake = np.sqrt(squares)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        error = np.where(use, (fake - real) / real, 0.0)
+
+        # Each point needs to be moved away from or towards the other point
+        # in proportion to how much error it has
+        weights = np.where(use & (fake > 0), error / fake, 0.0)
+
+    grad = loc * weights.sum(axis=1)[:, np.newaxis] - np.dot(weights, targets)
+    return np.abs(error).sum(), grad
+
+def descend(loc, real, use, targets=None, rate=0.01, iterations=1000, tol=1e-4):
+    """
+    Move the points in loc down the gradient until an iteration improves
+    the error by less than tol of what it was, and return the best
+    positions found with their error. The points are measured against
+    targets, which stay where they are, or against each other if targets
+    is None.
+    """
+    best = None
+    besterror = None
+    lasterror = None
+
+    for t in range(iterations):
+        (error, grad) = gradient(loc, loc if targets is None else targets, real, use)
+
+        if best is None or error < besterror:
+            (best, besterror) = (loc, error)
+
+        if lasterror is not None and lasterror - error <= tol * lasterror: break
+        lasterror = error
+
+        loc = loc - rate * grad
+
+    return best, besterror
+
+def mds(data, dims=2, metric='pearson', distance=None, rate=0.01, iterations=1000, tol=1e-4,
+        landmarks=None, seed=None):
+    """
+    Lay out the rows of data as points in dims dimensions whose distances
+    match the real distances between the rows as closely as possible, by
+    gradient descent from random positions as clusters.scaledown does.
+    Pairs at a real distance of 0 are left out, since a percent difference
+    from 0 is undefined.
+
+    metric is 'pearson' or 'tanimoto', or None to call distance for every
+    pair. data may be a list of rows, an array, a sparse matrix or a
+    wordmatrix.
+
+    With landmarks, only that many rows picked at random are laid out
+    against each other. Every other row is then placed against the fixed
+    landmarks, starting from its closest one, so only the distances to
+    the landmarks are ever computed or held in memory.
+    """
+    data = asrows(data)
+    n = data.shape[0]
+    rng = np.random.RandomState(seed)
+
+    if landmarks is None or landmarks >= n:
+        real = realdistances(data, np.arange(n), metric, distance)
+        use = real != 0
+        np.fill_diagonal(use, False)
+        return descend(rng.rand(n, dims), real, use, None, rate, iterations, tol)[0]
+
+    picked = np.sort(rng.choice(n, landmarks, replace=False))
+    real = realdistances(data, picked, metric, distance)
+
+    # Lay out the landmarks first
+    use = real[picked] != 0
+    np.fill_diagonal(use, False)
+    fixed = descend(rng.rand(landmarks, dims), real[picked], use, None, rate, iterations, tol)[0]
+
+    loc = np.zeros((n, dims))
+    loc[picked] = fixed
+
+    rest = np.setdiff1d(np.arange(n), picked)
+    if len(rest):
+        real = real[rest]
+        start = fixed[np.argmin(real, axis=1)]
+        loc[rest] = descend(start, real, real != 0, fixed, rate, iterations, tol)[0]
+
+    return loc
@@ -0,0 +1,193 @@
+import os
+import pickle
+import shutil
+import numpy as np
+from numpy.lib.format import open_memmap
+from scipy.sparse import csr_matrix, issparse
+
+class wordmatrix:
+    """
+    The data of a blogdata.txt style file: a name for every row and
+    column and the values as a CSR matrix, or as a dense array when loaded
+    with dense=True
+
+    Most of a word count matrix is zeros, so as CSR it takes memory in
+    proportion to the words actually used. hcluster, kcluster and scaledown
+    take a wordmatrix in place of a list of rows.
+    """
+    def __init__(self, rownames, colnames, counts):
+        self.rownames = rownames
+        self.colnames = colnames
+        self.counts = counts
+
+        self.row_ids = dict((name, i) for (i, name) in enumerate(rownames))
+        self.col_ids = dict((name, i) for (i, name) in enumerate(colnames))
+
+    def __len__(self):
+        return len(self.rownames)
+
+    def row(self, i):
+        # Row i as a dense array
+        if issparse(self.counts): return self.counts[i].toarray()[0]
+        return np.asarray(self.counts[i])
+
+def read_matrix(filename):
+    """
+    Read a tab separated file with column names on the first line and a
+    row name followed by the row's values on every other line. The file is
+    read a line at a time and only the non-zero values are kept.
+    """
+    rownames = []
+    indptr = [0]
+    indices = []
+    values = []
+
+    with open(filename, 'rb') as f:
+        # First line is the column titles
+        colnames = [intern(name) for name in f.readline().strip().split('\t')[1:]]
+
+        for (number, line) in enumerate(f):
+            line = line.strip()
+            if not line: continue
+
+            # First column in each row is the rowname
+            (name, rest) = (line.split('\t', 1) + [''])[:2]
+            row = np.fromstring(rest, sep='\t')
+
+            if len(row) != len(colnames):
+                raise ValueError('%s line %d has %d values for %d columns' %
+                                 (filename, number + 2, len(row), len(colnames)))
+
+            rownames.append(intern(name))
+            nonzero = row.nonzero()[0]
+            indices.append(nonzero.astype(np.int32))
+            values.append(row[nonzero])
+            indptr.append(indptr[-1] + len(nonzero))
+
+    counts = csr_matrix((np.concatenate(values) if values else np.zeros(0),
+                         np.concatenate(indices) if indices else np.zeros(0, dtype=np.int32),
+                         np.array(indptr, dtype=np.int64)),
+                        shape=(len(rownames), len(colnames)))
+
+    return wordmatrix(rownames, colnames, counts)
+
+def save_matrix(path, matrix):
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+    with open(os.path.join(path, 'names.pickle'), 'wb') as f:
+        pickle.dump((matrix.rownames, matrix.colnames), f, pickle.HIGHEST_PROTOCOL)
+
+    np.save(os.path.join(path, 'data.npy'), matrix.counts.data)
+    np.save(os.path.join(path, 'indices.npy'), matrix.counts.indices)
+    np.save(os.path.join(path, 'indptr.npy'), matrix.counts.indptr)
+
+def open_matrix(path):
+    """
+    Open a matrix saved by save_matrix, memory-mapping its arrays
+    """
+    with open(os.path.join(path, 'names.pickle'), 'rb') as f:
+        (rownames, colnames) = pickle.load(f)
+
+    arrays = [np.load(os.path.join(path, name + '.npy'), mmap_mode='r') for name in ('data', 'indices', 'indptr')]
+    counts = csr_matrix(tuple(arrays), shape=(len(rownames), len(colnames)), copy=False)
+
+    return wordmatrix(rownames, colnames, counts)
+
+def densify(path, matrix, blocksize=1024):
+    """
+    Write the matrix out as a dense array in path, a block of rows at a
+    time, and return it memory-mapped
+    """
+    dense = os.path.join(path, 'dense.npy')
+
+    if not os.path.exists(dense):
+        temp = '%s.%d.tmp' % (dense, os.getpid())
+        out = open_memmap(temp, mode='w+', dtype=np.float64, shape=matrix.counts.shape)
+        for start in range(0, len(matrix), blocksize):
+            out[start:start + blocksize] = matrix.counts[start:start + blocksize].toarray()
+        out.flush()
+        del out
+        os.rename(temp, dense)
+
+    return np.load(dense, mmap_mode='r')
+
+def load_matrix(filename, dense=False):
+    """
+    Load a blogdata.txt style file, keeping a binary copy of it in a
+    .cache directory next to it. The copy is memory-mapped on later loads
+    and rebuilt whenever the file is newer than it. With dense, the values
+    come as a memory-mapped dense array instead of a CSR matrix.
+    """
+    cache = filename + '.cache'
+    names = os.path.join(cache, 'names.pickle')
+
+    if os.path.exists(names) and os.path.getmtime(names) >= os.path.getmtime(filename):
+        matrix = open_matrix(cache)
+    else:
+        matrix = read_matrix(filename)
+
+        # Write to a temporary directory first so a crash never leaves half
+        # a cache, named after the process so concurrent loaders don't
+        # collide
+        temp = '%s.%d.tmp' % (cache, os.getpid())
+        save_matrix(temp, matrix)
+        if os.path.exists(cache): shutil.rmtree(cache)
+        os.rename(temp, cache)
+
+    if dense: matrix.counts = densify(cache, matrix)
+
+    return matrix
+
+def asrows(rows):
+    """
+    The rows of a wordmatrix, a sparse matrix or a list of rows, as a CSR
+    matrix or a float array that the clustering engines work on
+    """
+    if isinstance(rows, wordmatrix): rows = rows.counts
+
+    if issparse(rows): return rows.tocsr().astype(float, copy=False)
+    return np.asarray(rows, dtype=float)
+
+def rowsums(rows):
+    return np.asarray(rows.sum(axis=1)).ravel()
+
+def rowsquares(rows):
+    # Sum of the squares of each row
+    if issparse(rows): return rowsums(rows.multiply(rows))
+    return (rows * rows).sum(axis=1)
+
+def std(rows):
+    # Standard deviation of all the values
+    if issparse(rows):
+        size = float(rows.shape[0] * rows.shape[1])
+        mean = rows.sum() / size
+        return np.sqrt(max(rows.multiply(rows).sum() / size - mean * mean, 0.0))
+    return rows.std()
+
+def dot(a, b):
+    # a times b transposed as a dense array, for either of them sparse
+    if issparse(a):
+        product = a.dot(b.T)
+    elif issparse(b):
+        product = b.dot(a.T).T
+    else:
+        product = np.dot(a, b.T)
+
+    if issparse(product): return product.toarray()
+    return np.asarray(product)
+
+def nonzeros(rows):
+    # 1 where rows has a value, 0 elsewhere
+    if issparse(rows):
+        pattern = rows.copy()
+        pattern.eliminate_zeros()
+        pattern.data = np.ones(len(pattern.data))
+        return pattern
+
+    return (rows != 0).astype(float)
+
+def dense(rows):
+    # Rows as a dense array
+    if issparse(rows): return rows.toarray()
+    return np.asarray(rows)
@@ -1,63 +1,250 @@
-import re
+import hashlib
 import math
+import os
+import pickle
+import shutil
 import sqlite3
+import struct
+import tempfile
+import time
+from multiprocessing import Pool
+import numpy as np
+
+from tokenizer import getwords
+
+# Version of the fc/cc table layout, stored in the database's user_version
+schema_version = 2
+
+# UPSERT needs SQLite 3.24 or later
+has_upsert = sqlite3.sqlite_version_info >= (3, 24, 0)
+
+# Most bound parameters used in one statement, below SQLite's limit of 999
+max_variables = 500
+
+# Attributes that hold a classifier's counts rather than its settings
+state_attributes = ('conn', 'model', 'fc', 'cc', 'cattotals', 'cats', 'total', 'marginals', 'epoch')
+
+# Cached totals are rebased once they have halved this many times
+max_halvings = 32
 
 class classifier:
     def __init__(self, getfeatures, filename=None):
-        # Counts of feature/category combinations
+        # Counts of feature/category combinations and of documents in each
+        # category that haven't been written to the database yet, in the
+        # same units as the cached totals when counts decay
         self.fc = {}
-
-        # Counts of documents in each category
         self.cc = {}
         self.getfeatures = getfeatures
 
         # DB connection
         self.conn = None
 
+        # Read-only counts opened with setmodel, used instead of the database
+        self.model = None
+
+        # Seconds it takes counts to halve, None for counts that last forever
+        self.halflife = None
+
+        self.resettotals()
+
+    def setdecay(self, halflife):
+        """
+        Let the counts fade so that they halve every halflife seconds and
+        recent training outweighs old. Nothing is rewritten: each count is
+        stored with the time it was last updated and decayed when read.
+        None turns decay off again.
+        """
+        # Pending counts are stored in units that depend on halflife
+        if self.conn is not None: self.flush()
+
+        self.halflife = halflife
+        self.resettotals()
+
+    def now(self):
+        return time.time()
+
+    def decaying(self):
+        # A model from setmodel is a frozen copy and doesn't decay
+        return self.halflife is not None and self.model is None
+
+    def weight(self):
+        # What a count of 1 at self.epoch is worth now. The cached totals
+        # are kept in these units, so they decay without being rewritten.
+        if not self.decaying(): return 1
+        return 2.0 ** (-(self.now() - self.epoch) / self.halflife)
+
+    def unit(self):
+        # A count of 1 now in the units of the cached totals
+        if not self.decaying(): return 1
+        return 1.0 / self.weight()
+
+    def resettotals(self):
+        # Aggregates that only change on training, read from the database
+        # the first time they are needed and then kept up to date by incf
+        # and incc. cattotals holds the number of items in each category,
+        # cats the categories in order and marginals the number of times
+        # each feature has appeared in all categories.
+        now = self.now()
+        if self.decaying() and (self.fc or self.cc):
+            # Move the pending counts over to the new units
+            weight = 2.0 ** (-(now - self.epoch) / self.halflife)
+            for f in self.fc:
+                for cat in self.fc[f]: self.fc[f][cat] *= weight
+            for cat in self.cc: self.cc[cat] *= weight
+
+        self.cattotals = None
+        self.cats = None
+        self.total = 0
+        self.marginals = {}
+        self.epoch = now
+
+    def loadtotals(self):
+        # Start again before the cached totals get too small to be accurate
+        if self.cattotals is not None and self.weight() < 2.0 ** -max_halvings:
+            self.resettotals()
+
+        if self.cattotals is not None: return
+
+        self.cattotals = {}
+        self.cats = []
+        for (cat, count) in self.storedcats(self.epoch):
+            self.cattotals[cat] = count
+            self.cats.append(cat)
+
+        # Categories only seen since the last flush
+        for (cat, count) in self.cc.items():
+            if cat not in self.cattotals:
+                self.cattotals[cat] = 0
+                self.cats.append(cat)
+            self.cattotals[cat] += count
+
+        self.total = sum(self.cattotals.values())
+
     def incf(self, f, cat):
-        # Increase the count of a feature/category pair
-        count = self.fcount(f, cat)
-        if count == 0:
-            self.conn.execute("INSERT INTO fc(feature, category, count) VALUES ('%s', '%s', 1)" % (f, cat))
-        else:
-            self.conn.execute("UPDATE fc SET count = %d WHERE feature='%s' AND category='%s'" % (count+1, f, cat))
+        # Increase the count of a feature/category pair in memory, it is
+        # written to the database by flush
+        unit = self.unit()
+        self.fc.setdefault(f, {})
+        self.fc[f].setdefault(cat, 0)
+        self.fc[f][cat] += unit
 
-    def incc(self, cat):
-        # Increase the count of a category
-        count = self.catcount(cat)
+        if f in self.marginals: self.marginals[f] += unit
 
-        if count == 0:
-            self.conn.execute("INSERT INTO cc(category, count) VALUES ('%s', 1)" % (cat))
-        else:
-            self.conn.execute("UPDATE cc SET count=%d WHERE category='%s'" % (count+1, cat))
+    def incc(self, cat):
+        # Increase the count of a category in memory
+        unit = self.unit()
+        self.cc.setdefault(cat, 0)
+        self.cc[cat] += unit
+
+        if self.cattotals is not None:
+            if cat not in self.cattotals:
+                self.cattotals[cat] = 0
+                self.cats.append(cat)
+            self.cattotals[cat] += unit
+            self.total += unit
 
     def fcount(self, f, cat):
         # The number of times a feature has appeared in a category
-        res = self.conn.execute("SELECT count FROM fc WHERE feature='%s' AND category='%s'" % (f, cat)).fetchone()
+        if self.model is not None: return float(self.model.count(f, cat))
+
+        res = self.conn.execute("SELECT count, updated FROM fc WHERE feature=? AND category=?", (f, cat)).fetchone()
 
-        if res == None: return 0
-        else: return float(res[0])
+        # Include counts that haven't been flushed yet
+        pending = self.fc.get(f, {}).get(cat, 0) * self.weight()
+
+        if res == None: return float(pending)
+        else: return float(decayed(res[0], res[1], self.now(), self.halflife) + pending)
 
     def catcount(self, cat):
         # The number of items in a category
-        res = self.conn.execute("SELECT count FROM cc WHERE category='%s'" % (cat)).fetchone()
-
-        if res == None:
-            return 0
-        else:
-            return float(res[0])
+        self.loadtotals()
+        return float(self.cattotals.get(cat, 0)) * self.weight()
 
     def totalcount(self):
         # The total number of items
-        res = self.conn.execute("SELECT sum(count) FROM cc").fetchone()
-        if res == None: return 0
-        return res[0]
+        self.loadtotals()
+        return self.total * self.weight()
 
     def categories(self):
-        cur = self.conn.execute("SELECT category FROM cc")
-        return [d[0] for d in cur]
+        self.loadtotals()
+        return list(self.cats)
+
+    def featuretotal(self, f):
+        # The number of times a feature has appeared in all categories
+        self.loadtotals()
+        if f in self.marginals: return float(self.marginals[f]) * self.weight()
+
+        if self.model is not None:
+            total = self.model.total(f)
+        else:
+            cur = self.conn.execute("SELECT count, updated FROM fc WHERE feature=?", (f,))
+            stored = sum(decayed(count, updated, self.epoch, self.halflife) for (count, updated) in cur)
+            total = stored + sum(self.fc.get(f, {}).values())
+
+        # Only features that have been trained are kept, so the cache grows
+        # with the model rather than with everything classified
+        if total: self.marginals[f] = total
+
+        return float(total) * self.weight()
+
+    def flush(self):
+        """
+        Write the counts accumulated in memory to the database in a single
+        transaction. Either all of them are stored or, if anything fails,
+        none are and they stay in memory.
+        """
+        if not self.fc and not self.cc: return
+        self.checkwritable()
+
+        now = self.now()
+        (fpending, cpending) = self.pending()
+        fcounts = [(f, cat, count, now) for (f, cat, count) in fpending]
+        ccounts = [(cat, count, now) for (cat, count) in cpending]
+
+        # With decay the stored count is decayed up to now before adding,
+        # with now and the halflife bound like the counts
+        if self.halflife is None:
+            (stored, decay) = ("count", ())
+        else:
+            (stored, decay) = ("decayed(count, updated, ?, ?)", (now, float(self.halflife)))
+
+        with self.conn:
+            if has_upsert:
+                self.conn.executemany("INSERT INTO fc(feature, category, count, updated) VALUES (?, ?, ?, ?) "
+                                      "ON CONFLICT(feature, category) DO UPDATE "
+                                      "SET count=%s+excluded.count, updated=excluded.updated" % stored,
+                                      [row + decay for row in fcounts])
+                self.conn.executemany("INSERT INTO cc(category, count, updated) VALUES (?, ?, ?) "
+                                      "ON CONFLICT(category) DO UPDATE "
+                                      "SET count=%s+excluded.count, updated=excluded.updated" % stored,
+                                      [row + decay for row in ccounts])
+            else:
+                # Make sure every key has a row, then add the counts to it
+                self.conn.executemany("INSERT OR IGNORE INTO fc(feature, category, count, updated) VALUES (?, ?, 0, ?)",
+                                      [(f, cat, now) for (f, cat, count, now) in fcounts])
+                self.conn.executemany("UPDATE fc SET count=%s+?, updated=? WHERE feature=? AND category=?" % stored,
+                                      [decay + (count, now, f, cat) for (f, cat, count, now) in fcounts])
+                self.conn.executemany("INSERT OR IGNORE INTO cc(category, count, updated) VALUES (?, 0, ?)",
+                                      [(cat, now) for (cat, count, now) in ccounts])
+                self.conn.executemany("UPDATE cc SET count=%s+?, updated=? WHERE category=?" % stored,
+                                      [decay + (count, now, cat) for (cat, count, now) in ccounts])
+
+        self.fc = {}
+        self.cc = {}
+
+    def pending(self):
+        # The (feature, category, count) and (category, count) pairs that
+        # haven't been flushed, as they stand now
+        weight = self.weight()
+        return ([(f, cat, count * weight) for f in self.fc for (cat, count) in self.fc[f].items()],
+                [(cat, count * weight) for (cat, count) in self.cc.items()])
+
+    def checkwritable(self):
+        if self.model is not None:
+            raise ValueError('%s was opened with setmodel and is read-only' % self.model.path)
 
     def train(self, item, cat):
+        self.checkwritable()
         features = self.getfeatures(item)
 
         # Increment the count for every feature with this category
@@ -67,7 +254,26 @@ class classifier:
         # Increment the count for this category
         self.incc(cat)
 
-        self.conn.commit()
+        self.flush()
+
+    def train_many(self, items, batchsize=1000):
+        """
+        Train on an iterable of (item, category) pairs, writing the counts
+        to the database every batchsize items. A crash loses at most the
+        current batch, never part of one.
+        """
+        self.checkwritable()
+        trained = 0
+
+        for (item, cat) in items:
+            for f in self.getfeatures(item):
+                self.incf(f, cat)
+            self.incc(cat)
+
+            trained += 1
+            if trained % batchsize == 0: self.flush()
+
+        self.flush()
 
     def fprob(self, f, cat):
         if self.catcount(cat) == 0:
@@ -83,41 +289,223 @@ class classifier:
 
         # Count the number of times this feature has appeared in all
         # categories
-        totals = sum([self.fcount(f,c) for c in self.categories()])
+        totals = self.featuretotal(f)
 
         weightedprob = ((weight * ap) + (totals * basicprob)) / (weight + totals)
 
         return weightedprob
 
+    def featurecounts(self, features):
+        """
+        Counts of every feature in every category, fetched from the database
+        in bulk. Returns the categories and an array with one row per
+        feature and one column per category.
+        """
+        cats = self.categories()
+        column = dict((c, i) for (i, c) in enumerate(cats))
+
+        # Look each distinct feature up once
+        row = {}
+        distinct = []
+        for f in features:
+            if f not in row:
+                row[f] = len(distinct)
+                distinct.append(f)
+        counts = np.zeros((len(distinct), len(cats)))
+
+        # The database hands features back as text, so match on that
+        keys = [featurekey(f) for f in distinct]
+        keyrow = dict((k, row[f]) for (k, f) in zip(keys, distinct))
+
+        if self.model is not None:
+            self.model.addcounts(counts, distinct, [column[c] for c in self.model.categories])
+            keys = []
+
+        now = self.now()
+
+        for start in range(0, len(keys), max_variables):
+            chunk = keys[start:start + max_variables]
+            sql = "SELECT feature, category, count, updated FROM fc WHERE feature IN (%s)" % ','.join('?' * len(chunk))
+
+            found = self.conn.execute(sql, chunk).fetchall()
+            if not found: continue
+
+            rows = [keyrow[f] for (f, cat, count, updated) in found]
+            cols = [column[cat] for (f, cat, count, updated) in found]
+            values = np.array([count for (f, cat, count, updated) in found], dtype=float)
+            if self.decaying():
+                updated = np.array([updated for (f, cat, count, updated) in found])
+                values *= 2.0 ** (-(now - updated) / self.halflife)
+
+            # (feature, category) is the primary key, so no cell comes twice
+            counts[rows, cols] += values
+
+        # Include counts that haven't been flushed yet
+        weight = self.weight()
+        for f in distinct:
+            for (cat, count) in self.fc.get(f, {}).items():
+                counts[row[f], column[cat]] += count * weight
+
+        # The lookup gives the features' marginal totals for free
+        for (f, total) in zip(distinct, counts.sum(axis=1)):
+            if total: self.marginals.setdefault(f, total / weight)
+
+        return cats, counts[[row[f] for f in features]]
+
+    def catcounts(self, cats):
+        self.loadtotals()
+        return np.array([self.cattotals.get(c, 0) for c in cats], dtype=float) * self.weight()
+
+    def fprobs(self, counts, catcounts):
+        # fprob for a whole array of feature counts
+        safe = np.where(catcounts == 0, 1, catcounts)
+        return np.where(catcounts == 0, 0, counts / safe)
+
+    def weightedprobs(self, counts, basicprobs, weight=1.0, ap=0.5):
+        # weightedprob for a whole array of feature counts
+        totals = counts.sum(axis=1)[:, np.newaxis]
+        return ((weight * ap) + (totals * basicprobs)) / (weight + totals)
+
+    def storedcounts(self, at=None):
+        # (feature, category, count) for every stored count, decayed to
+        # the time at
+        if self.model is not None: return self.model.items()
+        if at is None: at = self.now()
+
+        cur = self.conn.execute("SELECT feature, category, count, updated FROM fc")
+        return [(f, cat, decayed(count, updated, at, self.halflife)) for (f, cat, count, updated) in cur]
+
+    def storedcats(self, at=None):
+        if self.model is not None: return zip(self.model.categories, self.model.catcounts)
+        if at is None: at = self.now()
+
+        cur = self.conn.execute("SELECT category, count, updated FROM cc")
+        return [(cat, decayed(count, updated, at, self.halflife)) for (cat, count, updated) in cur]
+
+    def prune(self, threshold):
+        """
+        Delete the feature counts that have decayed below threshold, so the
+        database and the cost of looking features up stop growing with
+        every feature ever seen. Without decay this drops the features seen
+        fewer than threshold times in a category. Returns the number of
+        counts deleted.
+        """
+        self.checkwritable()
+        self.flush()
+
+        with self.conn:
+            cur = self.conn.execute("DELETE FROM fc WHERE decayed(count, updated, ?, ?) < ?",
+                                    (self.now(), self.halflife, threshold))
+        self.resettotals()
+
+        return cur.rowcount
+
+    def settings(self):
+        # Everything about the classifier apart from its counts
+        return dict((k, v) for (k, v) in self.__dict__.items() if k not in state_attributes)
+
+    def exportmodel(self, path):
+        """
+        Save the counts, including any not yet flushed, and the settings in
+        the directory path for setmodel and loadmodel. path is replaced as a
+        whole, so processes using a model already exported there carry on
+        with the old one until they open it again.
+        """
+        cats = self.categories()
+        column = dict((c, i) for (i, c) in enumerate(cats))
+
+        fc = {}
+        for (f, cat, count) in self.storedcounts():
+            fc.setdefault(featurekey(f), {})
+            fc[featurekey(f)][cat] = count
+        for (f, cat, count) in self.pending()[0]:
+            row = fc.setdefault(featurekey(f), {})
+            row[cat] = row.get(cat, 0) + count
+
+        # Intern the features: integer ids in one sorted array, then the
+        # text features as UTF-8 sorted by hash, so a lookup is a binary
+        # search either way. Rows of the count array follow the same order.
+        ids = sorted(intkey(k) for k in fc if intkey(k) is not None)
+        texts = sorted((texthash(k), k.encode('utf-8'), k) for k in fc if intkey(k) is None)
+        keys = [unicode(i) for i in ids] + [k for (h, encoded, k) in texts]
+
+        counts = np.zeros((len(keys), len(cats)))
+        for (i, k) in enumerate(keys):
+            for (cat, count) in fc[k].items():
+                counts[i, column[cat]] = count
+
+        # Most models fit in 32 bits, unless decay has made the counts
+        # fractional
+        if counts.size == 0 or (counts.max() < 2 ** 31 and (counts == np.round(counts)).all()):
+            counts = counts.astype(np.int32)
+
+        save_model(path, {'class': self.__class__,
+                          'settings': self.settings(),
+                          'categories': cats,
+                          'catcounts': [self.cattotals[c] * self.weight() for c in cats]},
+                   {'ids': np.array(ids, dtype=np.int64),
+                    'hashes': np.array([h for (h, encoded, k) in texts], dtype=np.int64),
+                    'text': np.frombuffer(''.join(encoded for (h, encoded, k) in texts), dtype=np.uint8),
+                    'offsets': np.cumsum([0] + [len(encoded) for (h, encoded, k) in texts]).astype(np.int64),
+                    'counts': counts})
+
+    def classify_many(self, items, default=None, processes=None, chunksize=100):
+        """
+        Classify a list of items across a pool of processes, returning the
+        categories in the same order as items. The workers memory-map the
+        same exported copy of the model, so they share one copy of the
+        counts between them.
+        """
+        items = list(items)
+        if processes == 1: return [self.classify(item, default) for item in items]
+
+        if self.model is not None and not self.fc and not self.cc:
+            path = self.model.path
+            temporary = None
+        else:
+            temporary = tempfile.mkdtemp()
+            path = temporary
+            self.exportmodel(path)
+
+        try:
+            pool = Pool(processes, initializer=init_classify_worker, initargs=(path,))
+            try:
+                return pool.map(classify_worker, [(item, default) for item in items], chunksize)
+            finally:
+                pool.close()
+                pool.join()
+        finally:
+            if temporary is not None: shutil.rmtree(temporary)
+
+    def setmodel(self, path):
+        """
+        Classify with counts saved by exportmodel instead of a database. The
+        counts are memory-mapped rather than read in, and can't be trained.
+        """
+        self.conn = None
+        self.model = countmodel(path)
+        self.resettotals()
+
     def setdb(self, dbfile):
         """
         Set up an SQLite database instance to store training results
         """
         # Create the database for storing training results
         self.conn = sqlite3.connect(dbfile)
-
-        # SQL for setting up table to store feature counts
-        fc_table_sql = """
-                    CREATE TABLE IF NOT EXISTS fc(
-                        feature TEXT,
-                        category VARCHAR(255),
-                        count INT
-                    );
-                    """
-
-        # SQL for setting up table for storing category counts
-        cc_table_sql = """
-                    CREATE TABLE IF NOT EXISTS cc(
-                        category VARCHAR(255),
-                        count INT
-                    );
-                    """
+        self.conn.create_function('decayed', 4, decayed)
+        self.model = None
+        self.resettotals()
 
         if self.conn is not None:
             try:
-                c = self.conn.cursor()
-                c.execute(fc_table_sql)
-                c.execute(cc_table_sql)
+                # Write-ahead logging lets readers run alongside a flush, and
+                # with it a commit only needs to sync at checkpoints
+                self.conn.execute("PRAGMA journal_mode=WAL")
+                self.conn.execute("PRAGMA synchronous=NORMAL")
+                self.conn.execute("PRAGMA cache_size=-65536")
+                self.conn.execute("PRAGMA temp_store=MEMORY")
+
+                migratedb(self.conn)
             except Exception as e:
                 return False
         else:
@@ -141,44 +529,77 @@ class naivebayes(classifier):
         return self.thresholds[cat]
 
     def classify(self, item, default=None):
-        probs = {}
+        # Compare the categories by log probability so long documents
+        # don't underflow to 0
+        (cats, logprobs) = self.logprobs(item)
+        logprobs = dict(zip(cats, logprobs))
 
         # Find the category with the highest probability
-        max = 0.0
+        best = None
+        max = -np.inf
 
-        for cat in self.categories():
-            probs[cat] = self.prob(item, cat)
-
-            if probs[cat] > max:
-                max = probs[cat]
+        for cat in cats:
+            if logprobs[cat] > max:
+                max = logprobs[cat]
                 best = cat
 
+        if best is None: return default
+
         # Make sure the probability exceeds threshold*next best
-        for cat in probs:
+        threshold = self.getthreshold(best)
+        logthreshold = math.log(threshold) if threshold > 0 else -np.inf
+
+        for cat in cats:
             if cat == best:
                 continue
 
-            if probs[cat] * self.getthreshold(best) > probs[best]:
+            if logprobs[cat] + logthreshold > logprobs[best]:
                 return default
 
         return best
 
-    def docprob(self, item, cat):
+    def logdocprob(self, item, cat):
         features = self.getfeatures(item)
 
-        # Multiply the probabilities of all the features together
-        p = 1
+        # Add up the logs of the probabilities of all the features
+        logp = 0.0
 
         for f in features:
-            p *= self.weightedprob(f, cat, self.fprob)
+            logp += math.log(self.weightedprob(f, cat, self.fprob))
 
-        return p
+        return logp
 
-    def prob(self, item, cat):
+    def docprob(self, item, cat):
+        return math.exp(self.logdocprob(item, cat))
+
+    def logprob(self, item, cat):
         catprob = self.catcount(cat) / self.totalcount()
-        docprob = self.docprob(item, cat)
+        if catprob == 0: return -np.inf
+
+        return self.logdocprob(item, cat) + math.log(catprob)
+
+    def prob(self, item, cat):
+        return math.exp(self.logprob(item, cat))
+
+    def logprobs(self, item):
+        """
+        logprob for every category at once, from a single bulk lookup of
+        the document's feature counts. Returns the categories and their
+        log probabilities.
+        """
+        features = list(self.getfeatures(item))
+        (cats, counts) = self.featurecounts(features)
+        catcounts = self.catcounts(cats)
 
-        return docprob * catprob
+        weighted = self.weightedprobs(counts, self.fprobs(counts, catcounts))
+
+        # Categories without documents have probability 0
+        with np.errstate(divide='ignore'):
+            return cats, np.log(weighted).sum(axis=0) + np.log(catcounts / self.totalcount())
+
+    def probs(self, item):
+        (cats, logprobs) = self.logprobs(item)
+        return cats, np.exp(logprobs)
 
 class fisherclassifier(classifier):
     def __init__(self, getfeatures):
@@ -197,8 +618,9 @@ class fisherclassifier(classifier):
         best = default
         max = 0.0
 
-        for c in self.categories():
-            p = self.fisherprob(item, c)
+        (cats, probs) = self.fisherprobs(item)
+
+        for (c, p) in zip(cats, probs):
             # Make sure it exceeds its minimum
             if p > self.getminimum(c) and p > max:
                 best = c
@@ -223,36 +645,311 @@ class fisherclassifier(classifier):
         return p
 
     def fisherprob(self, item, cat):
-        # Multiply all the probabilities together
-        p = 1
+        # Add up the logs of the probabilities, the same as taking the log of
+        # their product but without the product underflowing to 0
+        logp = 0.0
         features = self.getfeatures(item)
 
         for f in features:
-            p *= (self.weightedprob(f, cat, self.cprob))
+            logp += math.log(self.weightedprob(f, cat, self.cprob))
 
-        # Take the natural log and multiply by -2
-        fscore = -2 * math.log(p)
+        # Multiply by -2
+        fscore = -2 * logp
 
         # Use the inverse chi2 function to get a probability
         return self.invchi2(fscore, len(features)*2)
 
+    def fisherprobs(self, item):
+        """
+        fisherprob for every category at once, from a single bulk lookup of
+        the document's feature counts
+        """
+        features = list(self.getfeatures(item))
+        (cats, counts) = self.featurecounts(features)
+
+        # cprob: the frequency of each feature in a category divided by its
+        # frequency in all the categories
+        freqs = self.fprobs(counts, self.catcounts(cats))
+        freqsums = freqs.sum(axis=1)[:, np.newaxis]
+        cprobs = np.where(freqs == 0, 0, freqs / np.where(freqsums == 0, 1, freqsums))
+
+        logp = np.log(self.weightedprobs(counts, cprobs)).sum(axis=0)
+
+        # Multiply by -2, then use the inverse chi2 function to get a
+        # probability
+        return cats, [self.invchi2(-2 * lp, len(features) * 2) for lp in logp]
+
     def invchi2(self, chi, df):
         m = chi/2.0
-        sum = term = math.exp(-m)
+        if m <= 0: return 1.0
+
+        # The terms of the series are exp(-m) * m^i / i!. Build their logs
+        # and add them up in log space, since exp(-m) alone underflows for
+        # documents with many features
+        logterms = -m + np.cumsum(np.concatenate(([0.0], math.log(m) - np.log(np.arange(1, df//2)))))
+        logsum = np.logaddexp.reduce(logterms)
+
+        return min(math.exp(logsum), 1.0)
+
+def decayed(count, updated, at, halflife):
+    # A count last updated at time updated as it stands at time at
+    if halflife is None: return float(count)
+    return count * 2.0 ** (-(at - updated) / halflife)
+
+def featurekey(f):
+    # Features are stored as text, including the integer ids from
+    # tokenizer.hashedfeatures
+    if isinstance(f, (int, long)): return unicode(f)
+    if isinstance(f, str): return unicode(f, 'utf-8')
+    return f
+
+def intkey(key):
+    # The integer a feature key stands for, such as the ids from
+    # tokenizer.hashedfeatures, or None for other text
+    if not key.isdigit() or len(key) > 18: return None
+
+    try:
+        value = int(key)
+    except ValueError:
+        return None
+
+    if unicode(value) != key: return None
+    return value
+
+def texthash(key):
+    # 64 bits of md5, the same in every process unlike hash()
+    return struct.unpack('<q', hashlib.md5(key.encode('utf-8')).digest()[:8])[0]
+
+class countmodel:
+    """
+    Feature and category counts saved by classifier.exportmodel
+
+    The directory holds the integer feature ids in ids.npy, sorted, and
+    the text features as their UTF-8 bytes end to end in text.npy, with
+    where each starts in offsets.npy and sorted by the hash of each in
+    hashes.npy. counts.npy has one row per feature, ids first, and one
+    column per category. The categories, their item counts and the
+    classifier's settings are in model.pickle. Opening it only unpickles
+    model.pickle; the arrays are memory-mapped, so processes opening the
+    same model share its pages.
+    """
+    def __init__(self, path):
+        self.path = path
+
+        with open(os.path.join(path, 'model.pickle'), 'rb') as f:
+            model = pickle.load(f)
+
+        self.cls = model['class']
+        self.settings = model['settings']
+        self.categories = model['categories']
+        self.catcounts = model['catcounts']
+        self.column = dict((c, i) for (i, c) in enumerate(self.categories))
+
+        for name in ('ids', 'hashes', 'text', 'offsets', 'counts'):
+            setattr(self, name, np.load(os.path.join(path, name + '.npy'), mmap_mode='r'))
+
+    def rows(self, features):
+        # Row of each feature, -1 for features that aren't in the model
+        rows = np.full(len(features), -1, dtype=np.intp)
+        keys = [featurekey(f) for f in features]
+        ints = [(i, intkey(k)) for (i, k) in enumerate(keys)]
+
+        numbered = [(i, n) for (i, n) in ints if n is not None]
+        if numbered and len(self.ids):
+            positions = np.array([i for (i, n) in numbered], dtype=np.intp)
+            values = np.array([n for (i, n) in numbered], dtype=np.int64)
+            found = np.minimum(np.searchsorted(self.ids, values), len(self.ids) - 1)
+            hit = self.ids[found] == values
+            rows[positions[hit]] = found[hit]
+
+        named = [(i, keys[i]) for (i, n) in ints if n is None]
+        if named and len(self.hashes):
+            hashes = np.array([texthash(k) for (i, k) in named], dtype=np.int64)
+            starts = np.searchsorted(self.hashes, hashes)
+
+            # Compare the text of every feature with the same hash
+            for ((i, k), h, j) in zip(named, hashes, starts):
+                encoded = k.encode('utf-8')
+                while j < len(self.hashes) and self.hashes[j] == h:
+                    if self.text[self.offsets[j]:self.offsets[j + 1]].tostring() == encoded:
+                        rows[i] = len(self.ids) + j
+                        break
+                    j += 1
+
+        return rows
+
+    def key(self, row):
+        # The feature of a row, as text
+        if row < len(self.ids): return unicode(self.ids[row])
+
+        j = row - len(self.ids)
+        return self.text[self.offsets[j]:self.offsets[j + 1]].tostring().decode('utf-8')
+
+    def count(self, f, cat):
+        row = self.rows([f])[0]
+        if row < 0 or cat not in self.column: return 0
+        return float(self.counts[row, self.column[cat]])
+
+    def total(self, f):
+        row = self.rows([f])[0]
+        if row < 0: return 0
+        return float(self.counts[row].sum())
+
+    def addcounts(self, counts, features, columns):
+        # Add the counts of features to the rows of counts, with the
+        # model's categories going to columns
+        if len(features) == 0: return
+
+        rows = self.rows(features)
+        found = rows >= 0
+        counts[np.ix_(found.nonzero()[0], columns)] += self.counts[rows[found]]
+
+    def items(self):
+        (rows, cols) = self.counts.nonzero()
+        return [(self.key(r), self.categories[c], float(self.counts[r, c])) for (r, c) in zip(rows, cols)]
+
+def save_model(path, model, arrays):
+    # Write to a temporary directory first so a crash never pairs the
+    # categories of one export with the counts of another, named after the
+    # process so concurrent exports don't collide
+    temp = '%s.%d.tmp' % (path.rstrip(os.sep), os.getpid())
+    if os.path.exists(temp): shutil.rmtree(temp)
+    os.makedirs(temp)
+
+    with open(os.path.join(temp, 'model.pickle'), 'wb') as f:
+        pickle.dump(model, f, pickle.HIGHEST_PROTOCOL)
+
+    for (name, array) in arrays.items():
+        np.save(os.path.join(temp, name + '.npy'), array)
+
+    # The old files are renamed away rather than rewritten, so processes
+    # that have them memory-mapped keep reading the old model
+    path = path.rstrip(os.sep)
+    old = '%s.%d.old' % (path, os.getpid())
+
+    if os.path.exists(path): os.rename(path, old)
+    os.rename(temp, path)
+    if os.path.exists(old): shutil.rmtree(old)
+
+def loadmodel(path):
+    """
+    Open a model saved by exportmodel as a classifier of the class and
+    with the settings it was saved with
+    """
+    model = countmodel(path)
+
+    cl = model.cls(model.settings['getfeatures'])
+    cl.__dict__.update(model.settings)
+    cl.setmodel(path)
+
+    return cl
+
+# The classifier each worker process of classify_many uses
+worker_classifier = None
+
+def init_classify_worker(path):
+    global worker_classifier
+    worker_classifier = loadmodel(path)
+
+def classify_worker(args):
+    (item, default) = args
+    return worker_classifier.classify(item, default)
+
+def classifybenchmark(cl, items, processes=None):
+    """
+    Compare classifying items one call at a time with classify_many and
+    print the throughput of each
+    """
+    items = list(items)
+
+    start = time.time()
+    single = [cl.classify(item) for item in items]
+    single_time = time.time() - start
+
+    start = time.time()
+    many = cl.classify_many(items, processes=processes)
+    many_time = time.time() - start
+
+    print 'one at a time: %.2fs (%.0f items/s)' % (single_time, len(items) / single_time)
+    print 'classify_many: %.2fs (%.0f items/s)' % (many_time, len(items) / many_time)
+
+    if single != many: print 'warning: results differ'
+
+    return single_time, many_time
+
+def migratedb(conn):
+    """
+    Create the fc and cc tables, or bring tables from an older version of
+    this module up to the current schema
+    """
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    if version >= schema_version: return
+
+    tables = [row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")]
+    script = ""
+
+    if version < 1: script += migration_1(tables)
+
+    # Version 2: counts record when they were last updated, for decay.
+    # Existing counts are taken to be from now; a constant default means
+    # the rows themselves aren't rewritten
+    if version < 2:
+        script += """
+        ALTER TABLE fc ADD COLUMN updated REAL NOT NULL DEFAULT %r;
+        ALTER TABLE cc ADD COLUMN updated REAL NOT NULL DEFAULT %r;
+        """ % ((time.time(),) * 2)
+
+    script += "PRAGMA user_version = %d;" % schema_version
+
+    # Run the whole migration as one transaction
+    try:
+        conn.executescript("BEGIN;" + script + "COMMIT;")
+    except Exception:
+        try:
+            conn.execute("ROLLBACK")
+        except sqlite3.OperationalError:
+            # The failure already ended the transaction
+            pass
+        raise
+
+def migration_1(tables):
+    # Version 1: (feature, category) and category become primary keys.
+    # Older tables had no keys at all and may hold duplicate rows, which are
+    # summed on the way over
+    script = """
+        CREATE TABLE fc_new(
+            feature TEXT NOT NULL,
+            category TEXT NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (feature, category)
+        ) WITHOUT ROWID;
+
+        CREATE TABLE cc_new(
+            category TEXT NOT NULL PRIMARY KEY,
+            count INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID;
+        """
 
-        for i in range(1, df//2):
-            term *= m / i
-            sum += term
+    if 'fc' in tables:
+        script += """
+        INSERT INTO fc_new(feature, category, count)
+            SELECT feature, category, SUM(count) FROM fc GROUP BY feature, category;
+        DROP TABLE fc;
+        """
 
-        return min(sum, 1.0)
+    if 'cc' in tables:
+        script += """
+        INSERT INTO cc_new(category, count)
+            SELECT category, SUM(count) FROM cc GROUP BY category;
+        DROP TABLE cc;
+        """
 
-def getwords(doc):
-    splitter = re.compile('\\W*')
-    # Split the words by non-alpha characters
-    words = [s.lower() for s in splitter.split(doc) if len(s)>2 and len(s) < 20]
+    script += """
+        ALTER TABLE fc_new RENAME TO fc;
+        ALTER TABLE cc_new RENAME TO cc;
+        """
 
-    # Return the unique set of words only
-    return dict([(w,1) for w in words])
+    return script
 
 def sampletrain(cl):
     cl.train('Nobody owns the water.', 'good')
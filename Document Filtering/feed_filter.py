@@ -0,0 +1,284 @@
+import os
+import re
+import threading
+import time
+import urllib2
+from Queue import Queue
+from xml.etree import cElementTree as ElementTree
+
+from tokenizer import word_pattern
+
+# Elements that hold one entry in RSS and Atom feeds
+entry_tags = ('item', 'entry')
+
+# Where each field of an entry comes from, first match wins
+field_tags = {'title': ('title',),
+              'summary': ('summary', 'description', 'content', 'encoded'),
+              'creator': ('creator', 'author', 'name')}
+
+# Summaries are often HTML
+tag_pattern = re.compile(r'<[^>]+>')
+
+# Marks the end of one reader thread's feeds in the entry queue
+done = object()
+
+def localname(tag):
+    # Drop the {namespace} ElementTree puts in front of tag names
+    return tag.rsplit('}', 1)[-1]
+
+def openfeed(source):
+    if source.startswith('http://') or source.startswith('https://'):
+        return urllib2.urlopen(source)
+    return open(source, 'rb')
+
+def feedfiles(paths):
+    """
+    Expand directories in a list of files, directories and URLs into the
+    feed files they contain
+    """
+    for path in paths:
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                if os.path.isfile(os.path.join(path, name)):
+                    yield os.path.join(path, name)
+        else:
+            yield path
+
+def entries(source):
+    """
+    Generate the entries of an RSS or Atom feed as dictionaries with title,
+    summary, creator and source keys. The feed is parsed incrementally and
+    each entry is dropped from the tree once it has been read, so memory
+    doesn't grow with the size of the feed.
+    """
+    f = openfeed(source)
+    try:
+        stack = []
+
+        for (event, elem) in ElementTree.iterparse(f, events=('start', 'end')):
+            if event == 'start':
+                stack.append(elem)
+                continue
+
+            stack.pop()
+            if localname(elem.tag) not in entry_tags: continue
+
+            fields = {}
+            for child in elem.iter():
+                text = ''.join(child.itertext()).strip()
+                fields.setdefault(localname(child.tag), text)
+
+            entry = {'source': source}
+            for (field, tags) in field_tags.items():
+                entry[field] = ''
+                for tag in tags:
+                    if fields.get(tag):
+                        entry[field] = fields[tag]
+                        break
+            entry['summary'] = tag_pattern.sub(' ', entry['summary'])
+
+            yield entry
+
+            elem.clear()
+            if stack: stack[-1].remove(elem)
+    finally:
+        f.close()
+
+def entryfeatures(entry):
+    """
+    Features of a feed entry: the words of the title, marked as title
+    words, the words and word pairs of the summary, the creator and
+    whether the summary is mostly in capitals
+    """
+    features = set()
+
+    for word in word_pattern.findall(entry['title']):
+        if len(word) > 2 and len(word) < 20:
+            features.add('title:' + word.lower())
+
+    summarywords = [w for w in word_pattern.findall(entry['summary']) if len(w) > 2 and len(w) < 20]
+    uc = 0
+    for i in range(len(summarywords)):
+        w = summarywords[i]
+        if w.isupper(): uc += 1
+
+        features.add(w.lower())
+        if i < len(summarywords) - 1:
+            features.add(' '.join(s.lower() for s in summarywords[i:i + 2]))
+
+    if entry['creator']: features.add('creator:' + entry['creator'])
+
+    # Shouting
+    if summarywords and float(uc) / len(summarywords) > 0.3: features.add('UPPERCASE')
+
+    return features
+
+class stagestats:
+    """
+    Items handled and time spent by one stage of a feedpipeline. waiting
+    is time a stage spent blocked on a full queue.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.busy = 0.0
+        self.waiting = 0.0
+        self.lock = threading.Lock()
+
+    def add(self, items, busy, waiting=0.0):
+        with self.lock:
+            self.items += items
+            self.busy += busy
+            self.waiting += waiting
+
+    def rate(self):
+        if self.busy == 0: return 0.0
+        return self.items / self.busy
+
+class feedpipeline:
+    """
+    Stream the entries of many feeds through a classifier
+
+    Reader threads each take a feed at a time, parse it and put its entries
+    on a queue holding at most queuesize entries. When the queue is full
+    the readers wait, so a slow classifier holds back parsing instead of
+    letting entries pile up. The calling thread takes entries off the
+    queue batchsize at a time and classifies or trains on them with a
+    docclass classifier built with entryfeatures, e.g.
+
+        cl = docclass.fisherclassifier(entryfeatures)
+        cl.setdb('feeds.db')
+        pipeline = feedpipeline(['feeds/', 'http://localhost:8000/python.xml'])
+        for (entry, cat) in pipeline.classify(cl): print cat, entry['title']
+        pipeline.report()
+
+    The classifier is only used from the calling thread, as sqlite3
+    connections require.
+    """
+    def __init__(self, sources, threads=4, queuesize=1000, batchsize=100):
+        self.sources = list(feedfiles(sources))
+        self.threads = threads
+        self.queuesize = queuesize
+        self.batchsize = batchsize
+
+        self.errors = []
+        self.stats = {}
+        self.started = None
+        self.finished = None
+
+    def read(self, sources, queue):
+        # Reader thread: parse feeds until there are none left
+        stats = self.stats['read']
+
+        while True:
+            try:
+                source = sources.pop()
+            except IndexError:
+                break
+
+            start = time.time()
+            waiting = 0.0
+            count = 0
+
+            try:
+                for entry in entries(source):
+                    put = time.time()
+                    queue.put(entry)
+                    waiting += time.time() - put
+                    count += 1
+            except Exception as e:
+                # Entries before the error have already gone through
+                self.errors.append((source, e))
+
+            stats.add(count, time.time() - start - waiting, waiting)
+
+        queue.put(done)
+
+    def batches(self, stage):
+        """
+        Generate lists of at most batchsize entries from all the feeds,
+        resetting the stats for reading and for stage
+        """
+        self.stats = {'read': stagestats('read'), stage: stagestats(stage)}
+        self.errors = []
+        self.started = time.time()
+        self.finished = None
+
+        queue = Queue(self.queuesize)
+        sources = list(reversed(self.sources))
+        readers = [threading.Thread(target=self.read, args=(sources, queue))
+                   for i in range(min(self.threads, len(sources)))]
+        for reader in readers:
+            reader.daemon = True
+            reader.start()
+
+        running = len(readers)
+        batch = []
+
+        while running:
+            entry = queue.get()
+
+            if entry is done:
+                running -= 1
+                continue
+
+            batch.append(entry)
+            if len(batch) == self.batchsize:
+                yield batch
+                batch = []
+
+        if batch: yield batch
+
+        for reader in readers: reader.join()
+        self.finished = time.time()
+
+    def classify(self, cl, default=None, processes=1):
+        """
+        Generate (entry, category) for every entry of every feed. processes
+        is passed on to classify_many; leave it at 1 unless batches are
+        large, since each batch starts its own pool.
+        """
+        for batch in self.batches('classify'):
+            start = time.time()
+            cats = cl.classify_many(batch, default, processes=processes)
+            self.stats['classify'].add(len(batch), time.time() - start)
+
+            for (entry, cat) in zip(batch, cats):
+                yield entry, cat
+
+    def train(self, cl, label):
+        """
+        Train on every entry that label(entry) gives a category for and
+        return how many there were
+        """
+        trained = 0
+
+        for batch in self.batches('train'):
+            start = time.time()
+            items = [(entry, label(entry)) for entry in batch]
+            items = [(entry, cat) for (entry, cat) in items if cat is not None]
+            cl.train_many(items, batchsize=len(batch))
+            self.stats['train'].add(len(items), time.time() - start)
+            trained += len(items)
+
+        return trained
+
+    def report(self):
+        """
+        Print the throughput of each stage
+        """
+        for name in ('read', 'classify', 'train'):
+            stats = self.stats.get(name)
+            if stats is None: continue
+
+            print '%-8s %8d entries %8.2fs busy %8.2fs blocked %10.0f entries/s' % \
+                  (name, stats.items, stats.busy, stats.waiting, stats.rate())
+
+        if self.finished is not None:
+            total = self.stats['read'].items
+            elapsed = self.finished - self.started
+            print '%-8s %8d entries %8.2fs %29.0f entries/s' % \
+                  ('overall', total, elapsed, total / elapsed if elapsed else 0.0)
+
+        for (source, e) in self.errors:
+            print 'error reading %s: %s' % (source, e)
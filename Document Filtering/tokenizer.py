@@ -0,0 +1,80 @@
+import re
+import zlib
+
+# A word is a run of letters, digits or underscores, the same words the
+# old split on \W* produced
+word_pattern = re.compile(r'\w+')
+
+# A document ending in the middle of a word
+partial_pattern = re.compile(r'\w+\Z')
+
+def tokens(text):
+    """
+    Generate the lowercased words of a string that are between 3 and 19
+    characters long
+    """
+    for match in word_pattern.finditer(text):
+        word = match.group()
+        if len(word) > 2 and len(word) < 20:
+            yield word.lower()
+
+def stream_tokens(f, chunksize=1 << 16):
+    """
+    Generate the words of a file object, reading it chunksize characters at
+    a time. A word cut off at the end of a chunk is carried over and joined
+    with the start of the next one.
+    """
+    rest = ''
+
+    while True:
+        chunk = f.read(chunksize)
+        if not chunk: break
+
+        text = rest + chunk
+        partial = partial_pattern.search(text)
+
+        if partial is None:
+            rest = ''
+        else:
+            rest = partial.group()
+            text = text[:partial.start()]
+
+        for word in tokens(text):
+            yield word
+
+    for word in tokens(rest):
+        yield word
+
+def getwords(doc):
+    """
+    The unique words of a document, given either as a string or as a file
+    object which is read in chunks rather than all at once
+    """
+    if hasattr(doc, 'read'):
+        return set(stream_tokens(doc))
+
+    return set(tokens(doc))
+
+class hashedfeatures:
+    """
+    Feature extractor for the hashing trick: each feature from getfeatures
+    is mapped to one of buckets integer ids, so the number of distinct
+    features, and with it the size of the count store, never exceeds
+    buckets however large the vocabulary grows. Distinct words sharing a
+    bucket are counted together.
+
+    Use an instance wherever a getfeatures function is expected, e.g.
+    naivebayes(hashedfeatures(2 ** 18)).
+    """
+    def __init__(self, buckets=1 << 20, getfeatures=getwords):
+        self.buckets = buckets
+        self.getfeatures = getfeatures
+
+    def __call__(self, doc):
+        return set(self.bucket(f) for f in self.getfeatures(doc))
+
+    def bucket(self, f):
+        if isinstance(f, unicode): f = f.encode('utf-8')
+
+        # crc32 rather than hash() so ids are the same in every process
+        return (zlib.crc32(f) & 0xffffffff) % self.buckets
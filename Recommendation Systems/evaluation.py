@@ -0,0 +1,222 @@
+import json
+import os
+import resource
+import shutil
+import tempfile
+import time
+from multiprocessing import Pool
+import numpy as np
+
+import movielens
+from recommendations import recommend_many, get_recommended_items
+from sparseprefs import sparseprefs
+from ranking import top_row
+from itemindex import build_item_index
+from factorization import factormodel, split
+
+class userknn:
+    """
+    User-based recommendations, as in get_recommendations
+    """
+    def __init__(self, train):
+        self.prefs = movielens.to_prefs(train)
+        self.engine = sparseprefs(self.prefs)
+        self.mean = float(np.mean(train['rating']))
+
+    def predict(self, users, items):
+        result = np.full(len(users), self.mean)
+        people = [str(u) for u in np.unique(users) if str(u) in self.engine.person_ids]
+        if len(people) == 0: return result
+
+        rows = dict((p, i) for (i, p) in enumerate(people))
+        sims = self.engine.rows(self.engine.ids(people), 'pearson')
+        sims[np.arange(len(people)), self.engine.ids(people)] = 0
+        sims[sims <= 0] = 0
+
+        # Weighted sums for every (person, item) at once
+        totals = (self.engine.ratings.T * sims.T).T
+        sim_sums = (self.engine.mask.T * sims.T).T
+
+        for (j, (user, item)) in enumerate(zip(users.tolist(), items.tolist())):
+            row = rows.get(str(user))
+            col = self.engine.item_ids.get(str(item))
+            if row is None or col is None or sim_sums[row, col] <= 0: continue
+            result[j] = totals[row, col] / sim_sums[row, col]
+
+        return result
+
+    def recommend(self, users, k):
+        people = [str(u) for u in users]
+        return [[int(item) for (score, item) in ranking]
+                for ranking in recommend_many(self.prefs, people, n=k, engine=self.engine)]
+
+class itemknn:
+    """
+    Item-based recommendations from an item similarity index, as in
+    get_recommended_items
+    """
+    def __init__(self, train, n=50):
+        self.prefs = movielens.to_prefs(train)
+        self.mean = float(np.mean(train['rating']))
+        self.path = tempfile.mkdtemp()
+        self.index = build_item_index(self.prefs, self.path, n=n)
+        self.rankings = {}
+
+    def ranking(self, user):
+        if user not in self.rankings:
+            self.rankings[user] = get_recommended_items(self.prefs, self.index, user)
+
+        return self.rankings[user]
+
+    def predict(self, users, items):
+        result = np.full(len(users), self.mean)
+        scores = {}
+
+        for (j, (user, item)) in enumerate(zip(users.tolist(), items.tolist())):
+            if str(user) not in self.prefs: continue
+            if user not in scores:
+                scores[user] = dict((i, s) for (s, i) in self.ranking(str(user)))
+            result[j] = scores[user].get(str(item), self.mean)
+
+        return result
+
+    def recommend(self, users, k):
+        return [[int(item) for (score, item) in self.ranking(str(u))[:k]] if str(u) in self.prefs else []
+                for u in users]
+
+    def close(self):
+        shutil.rmtree(self.path)
+
+class factorrecommender:
+    """
+    Matrix factorization, see factorization.py
+    """
+    def __init__(self, train):
+        (fit, held_out) = split(train, 0.1, seed=0)
+        self.model = factormodel(seed=0)
+        self.model.train(fit, held_out)
+        self.seen = {}
+
+        for (user, item) in zip(train['user'].tolist(), train['item'].tolist()):
+            self.seen.setdefault(user, []).append(item)
+
+    def predict(self, users, items):
+        return self.model.predict_many(users, items)
+
+    def recommend(self, users, k):
+        model = self.model
+        rank = np.arange(len(model.items))
+        results = []
+
+        for user in users:
+            u = model.lookup([user], model.users)[0]
+            if u < 0:
+                results.append([])
+                continue
+
+            scores = np.dot(model.item_factors, model.user_factors[u])
+            seen = model.lookup(self.seen.get(user, []), model.items)
+            scores[seen[seen >= 0]] = -np.inf
+
+            results.append([int(model.items[i]) for i in top_row(scores, rank, k)])
+
+        return results
+
+recommenders = {'user': userknn, 'item': itemknn, 'mf': factorrecommender}
+
+def run_fold(args):
+    """
+    Train one recommender on one fold and measure it on the fold's test set
+    """
+    (name, path, fold, k, relevant) = args
+
+    start = time.time()
+    train = movielens.load_ratings(os.path.join(path, fold + '.base'))
+    test = movielens.load_ratings(os.path.join(path, fold + '.test'))
+
+    model = recommenders[name](train)
+    train_time = time.time() - start
+
+    # Rating prediction accuracy
+    start = time.time()
+    predicted = model.predict(test['user'], test['item'])
+    predict_time = time.time() - start
+
+    errors = predicted - test['rating']
+    rmse = float(np.sqrt(np.mean(np.power(errors, 2))))
+    mae = float(np.mean(np.abs(errors)))
+
+    # Ranking accuracy against the highly rated test items of each user
+    liked = {}
+    for (user, item, rating) in zip(test['user'].tolist(), test['item'].tolist(), test['rating'].tolist()):
+        if rating >= relevant: liked.setdefault(user, set()).add(item)
+
+    users = sorted(liked)
+    start = time.time()
+    recommended = model.recommend(users, k)
+    recommend_time = time.time() - start
+
+    precision = 0.0
+    recall = 0.0
+    for (user, items) in zip(users, recommended):
+        hits = len(liked[user].intersection(items))
+        precision += float(hits) / k
+        recall += float(hits) / len(liked[user])
+
+    if hasattr(model, 'close'): model.close()
+
+    return {'recommender': name,
+            'fold': fold,
+            'rmse': rmse,
+            'mae': mae,
+            'k': k,
+            'precision_at_k': precision / max(len(users), 1),
+            'recall_at_k': recall / max(len(users), 1),
+            'train_seconds': train_time,
+            'predict_seconds': predict_time,
+            'recommend_seconds': recommend_time,
+            'predictions': len(test),
+            'predictions_per_second': len(test) / predict_time if predict_time > 0 else None,
+            # ru_maxrss is in kilobytes on Linux
+            'peak_memory_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+
+def evaluate(names=('user', 'item', 'mf'), folds=('u1', 'u2', 'u3', 'u4', 'u5'), path='ml-100k', k=10,
+             relevant=4, processes=None, output='evaluation.json'):
+    """
+    Run each recommender over each fold of the MovieLens splits in parallel
+    processes and write the results to output as JSON
+
+    Use folds=('ua', 'ub') for the splits with exactly ten test ratings per
+    user. Items rated at least relevant in a test set count as hits for
+    precision@k and recall@k.
+    """
+    # Build the binary caches once up front instead of in every worker
+    for fold in folds:
+        movielens.load_ratings(os.path.join(path, fold + '.base'))
+        movielens.load_ratings(os.path.join(path, fold + '.test'))
+
+    tasks = [(name, path, fold, k, relevant) for name in names for fold in folds]
+
+    # A fresh process per task so the peak memory is per run
+    start = time.time()
+    pool = Pool(processes, maxtasksperchild=1)
+    try:
+        results = pool.map(run_fold, tasks, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+    report = {'path': path, 'k': k, 'wall_seconds': time.time() - start, 'results': results}
+
+    if output is not None:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+    for name in names:
+        runs = [r for r in results if r['recommender'] == name]
+        print '%-5s rmse %.4f  mae %.4f  p@%d %.4f  r@%d %.4f  %.0f predictions/s' % (
+            name, np.mean([r['rmse'] for r in runs]), np.mean([r['mae'] for r in runs]),
+            k, np.mean([r['precision_at_k'] for r in runs]), k, np.mean([r['recall_at_k'] for r in runs]),
+            np.mean([r['predictions_per_second'] for r in runs]))
+
+    return report
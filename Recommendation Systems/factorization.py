@@ -0,0 +1,183 @@
+from multiprocessing import Pool
+import numpy as np
+from scipy.sparse import csr_matrix
+
+def solve_rows(args):
+    """
+    Solve the regularized least squares problem for a range of rows of the
+    rating matrix, keeping the factors of the other side fixed. The systems
+    of all the rows are built and solved together as one (rows, k, k) stack.
+    """
+    (indptr, indices, data, fixed, regularization) = args
+    k = fixed.shape[1]
+    rows = len(indptr) - 1
+    counts = np.diff(indptr)
+
+    # The systems are symmetric, so only the upper triangle of each fixed
+    # vector's outer product with itself is summed over the row's columns
+    (upper, lower) = np.triu_indices(k)
+    pattern = csr_matrix((np.ones(len(indices)), indices, indptr), shape=(rows, len(fixed)))
+    triangle = pattern.dot(fixed[:, upper] * fixed[:, lower])
+
+    a = np.zeros((rows, k, k))
+    a[:, upper, lower] = triangle
+    a[:, lower, upper] = triangle
+    a += (regularization * counts)[:, np.newaxis, np.newaxis] * np.eye(k)
+    b = csr_matrix((data, indices, indptr), shape=(rows, len(fixed))).dot(fixed)
+
+    # Rows with no ratings keep zero factors
+    a[counts == 0] = np.eye(k)
+
+    return np.linalg.solve(a, b[:, :, np.newaxis])[:, :, 0]
+
+def split(ratings, fraction=0.1, seed=None):
+    """
+    Randomly split a ratings array into training and held-out parts
+    """
+    held_out = np.random.RandomState(seed).rand(len(ratings)) < fraction
+    return ratings[~held_out], ratings[held_out]
+
+class factormodel:
+    """
+    Latent factor recommender trained with alternating least squares
+
+    Every user and item gets a vector of factors, and a predicted rating is
+    the global mean plus the dot product of the two vectors. Training
+    alternates between solving for all user vectors with the item vectors
+    fixed and the other way round. Each half step is a set of independent
+    small linear systems, which are spread over processes worker processes.
+    """
+    def __init__(self, factors=10, regularization=0.1, iterations=30, patience=2, processes=1, seed=None):
+        self.factors = factors
+        self.regularization = regularization
+        self.iterations = iterations
+        self.patience = patience
+        self.processes = processes
+        self.seed = seed
+
+        self.mean = 0.0
+        self.users = np.zeros(0, dtype=np.int64)
+        self.items = np.zeros(0, dtype=np.int64)
+        self.user_factors = np.zeros((0, factors))
+        self.item_factors = np.zeros((0, factors))
+        self.history = []
+
+    def half_step(self, matrix, fixed, pool):
+        chunks = []
+        step = max(1, matrix.shape[0] // (self.processes * 4))
+
+        for start in range(0, matrix.shape[0], step):
+            end = min(start + step, matrix.shape[0])
+            indptr = matrix.indptr[start:end + 1]
+            chunks.append((indptr - indptr[0], matrix.indices[indptr[0]:indptr[-1]],
+                           matrix.data[indptr[0]:indptr[-1]], fixed, self.regularization))
+
+        if pool is None: solved = [solve_rows(c) for c in chunks]
+        else: solved = pool.map(solve_rows, chunks)
+
+        return np.vstack(solved)
+
+    def train(self, ratings, validation=None):
+        """
+        Fit the model to a ratings array with user, item and rating fields
+        (as loaded by movielens.py). With a validation array, training
+        stops once the validation RMSE has not improved for patience
+        iterations and the best factors seen are kept.
+        """
+        (self.users, user_rows) = np.unique(ratings['user'], return_inverse=True)
+        (self.items, item_cols) = np.unique(ratings['item'], return_inverse=True)
+        self.mean = float(np.mean(ratings['rating']))
+
+        values = np.asarray(ratings['rating'], dtype=np.float64) - self.mean
+        shape = (len(self.users), len(self.items))
+        by_user = csr_matrix((values, (user_rows, item_cols)), shape=shape)
+        by_item = by_user.T.tocsr()
+
+        random = np.random.RandomState(self.seed)
+        self.user_factors = np.zeros((shape[0], self.factors))
+        self.item_factors = random.normal(scale=0.1, size=(shape[1], self.factors))
+        self.history = []
+
+        pool = None
+        if self.processes > 1: pool = Pool(self.processes)
+
+        best = None
+        best_error = None
+        stale = 0
+
+        try:
+            for i in range(self.iterations):
+                self.user_factors = self.half_step(by_user, self.item_factors, pool)
+                self.item_factors = self.half_step(by_item, self.user_factors, pool)
+
+                if validation is None: continue
+
+                error = self.rmse(validation)
+                self.history.append(error)
+
+                if best_error is None or error < best_error:
+                    best_error = error
+                    best = (self.user_factors, self.item_factors)
+                    stale = 0
+                else:
+                    stale += 1
+                    if stale >= self.patience: break
+        except:
+            # Stop the workers straight away rather than leave them running
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+            raise
+
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+        if best is not None: (self.user_factors, self.item_factors) = best
+
+    def lookup(self, ids, known):
+        # Position of each id in the sorted array of known ids, -1 if unseen
+        ids = np.asarray(ids)
+        if len(known) == 0: return np.full(ids.shape, -1, dtype=np.intp)
+
+        pos = np.clip(np.searchsorted(known, ids), 0, len(known) - 1)
+        return np.where(known[pos] == ids, pos, -1)
+
+    def predict_many(self, users, items):
+        """
+        Predicted ratings for arrays of user and item ids. Unseen users or
+        items get the global mean.
+        """
+        u = self.lookup(users, self.users)
+        i = self.lookup(items, self.items)
+        known = (u >= 0) & (i >= 0)
+
+        result = np.full(len(u), self.mean)
+        result[known] += np.einsum('ij,ij->i', self.user_factors[u[known]], self.item_factors[i[known]])
+        return result
+
+    def predict(self, user, item):
+        return float(self.predict_many([user], [item])[0])
+
+    def rmse(self, ratings):
+        errors = self.predict_many(ratings['user'], ratings['item']) - ratings['rating']
+        return float(np.sqrt(np.mean(np.power(errors, 2))))
+
+    def save(self, filename):
+        np.savez(filename, mean=self.mean, users=self.users, items=self.items,
+                 user_factors=self.user_factors, item_factors=self.item_factors)
+
+def load_model(filename):
+    """
+    Load a model written by factormodel.save
+    """
+    data = np.load(filename)
+    model = factormodel(factors=data['user_factors'].shape[1])
+
+    model.mean = float(data['mean'])
+    model.users = data['users']
+    model.items = data['items']
+    model.user_factors = data['user_factors']
+    model.item_factors = data['item_factors']
+
+    return model
@@ -0,0 +1,180 @@
+import os
+import pickle
+import shutil
+import numpy as np
+
+from recommendations import transform_prefs
+from sparseprefs import sparseprefs
+from ranking import top_row, item_rank
+
+class itemindex:
+    """
+    An on-disk item similarity index
+
+    For every item the index keeps the ids and scores of its n most similar
+    items (by sim_distance, the same as calculate_similar_items) in two
+    arrays saved with numpy. Opening an index only unpickles the item names
+    and memory-maps the arrays, and looking up an item returns the same
+    [(score, item2), ...] list as calculate_similar_items, so an index can be
+    passed straight to get_recommended_items.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.load()
+
+    def load(self):
+        with open(os.path.join(self.path, 'items.pickle'), 'rb') as f:
+            self.items = pickle.load(f)
+
+        self.item_ids = dict((item, i) for (i, item) in enumerate(self.items))
+        self.neighbours = np.load(os.path.join(self.path, 'neighbours.npy'), mmap_mode='r')
+        self.scores = np.load(os.path.join(self.path, 'scores.npy'), mmap_mode='r')
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, item):
+        return item in self.item_ids
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __getitem__(self, item):
+        row = self.item_ids[item]
+        return [(float(score), self.items[other])
+                for (score, other) in zip(self.scores[row], self.neighbours[row]) if other >= 0]
+
+    def keys(self):
+        return list(self.items)
+
+    def update(self, prefs, ratings):
+        """
+        Add a batch of (person, item, rating) tuples to prefs and bring the
+        index up to date with them.
+
+        Only the rows of the rated items are recomputed in full. Every other
+        row just compares its current neighbours against the new scores of
+        the rated items, unless one of those items was already among its
+        neighbours and its score may have dropped, in which case that row is
+        recomputed too.
+        """
+        affected = set()
+
+        for (person, item, rating) in ratings:
+            prefs.setdefault(person, {})
+            prefs[person][item] = rating
+            affected.add(item)
+
+        engine = sparseprefs(transform_prefs(prefs))
+        n = self.neighbours.shape[1]
+
+        # Items seen for the first time are appended to the index
+        items = self.items + [item for item in engine.people if item not in self.item_ids]
+        item_ids = dict((item, i) for (i, item) in enumerate(items))
+        perm = engine.ids(items)
+        rank = item_rank(items)
+
+        neighbours = np.full((len(items), n), -1, dtype=np.int32)
+        scores = np.zeros((len(items), n))
+        neighbours[:len(self.items)] = self.neighbours
+        scores[:len(self.items)] = self.scores
+
+        changed = np.array(sorted(item_ids[item] for item in affected), dtype=np.intp)
+        is_changed = np.zeros(len(items), dtype=bool)
+        is_changed[changed] = True
+
+        # The new similarity of every item to each of the rated items
+        changed_rows = engine.rows(perm[changed], 'distance')[:, perm]
+
+        # Rows to rebuild from scratch: the rated items, new items and rows
+        # that had a rated item among their neighbours
+        stale = is_changed.copy()
+        stale[len(self.items):] = True
+        old = neighbours[:len(self.items)]
+        stale[:len(self.items)] |= (is_changed[old] & (old >= 0)).any(axis=1)
+
+        for row in np.flatnonzero(~stale):
+            # Merge the unchanged neighbours with the new scores
+            candidates = np.concatenate((neighbours[row][neighbours[row] >= 0], changed))
+            candidate_scores = np.concatenate((scores[row][neighbours[row] >= 0], changed_rows[:, row]))
+            candidate_scores[candidates == row] = -np.inf
+
+            candidates, unique = np.unique(candidates, return_index=True)
+            candidate_scores = candidate_scores[unique]
+
+            best = top_row(candidate_scores, rank[candidates], n)
+            neighbours[row, :len(best)] = candidates[best]
+            scores[row, :len(best)] = candidate_scores[best]
+
+        stale_rows = np.flatnonzero(stale)
+        if len(stale_rows) > 0:
+            fill_rows(neighbours, scores, stale_rows, engine.rows(perm[stale_rows], 'distance')[:, perm], rank)
+
+        # The old files stay mapped, and keep serving, until the new ones are
+        # in place
+        save_index(self.path, items, neighbours, scores)
+        self.load()
+
+def fill_rows(neighbours, scores, rows, similarities, rank):
+    n = neighbours.shape[1]
+
+    for (row, row_scores) in zip(rows, similarities):
+        # An item is never its own neighbour
+        row_scores[row] = -np.inf
+        best = top_row(row_scores, rank, n)
+
+        neighbours[row] = -1
+        scores[row] = 0.0
+        neighbours[row, :len(best)] = best
+        scores[row, :len(best)] = row_scores[best]
+
+def save_index(path, items, neighbours, scores):
+    """
+    Save an index in the directory path, which is replaced as a whole
+    """
+    # Write to a temporary directory first so a crash never leaves item
+    # names that don't match the arrays, named after the process so
+    # concurrent writers don't collide
+    temp = '%s.%d.tmp' % (path.rstrip(os.sep), os.getpid())
+    if os.path.exists(temp): shutil.rmtree(temp)
+    os.makedirs(temp)
+
+    with open(os.path.join(temp, 'items.pickle'), 'wb') as f:
+        pickle.dump(items, f, pickle.HIGHEST_PROTOCOL)
+
+    np.save(os.path.join(temp, 'neighbours.npy'), neighbours)
+    np.save(os.path.join(temp, 'scores.npy'), scores)
+
+    replace_directory(temp, path)
+
+def replace_directory(temp, path):
+    # Move temp to path. The old files are renamed away rather than
+    # rewritten, so processes that have them memory-mapped keep reading
+    # the old data instead of a half-written file
+    path = path.rstrip(os.sep)
+    old = '%s.%d.old' % (path, os.getpid())
+
+    if os.path.exists(path): os.rename(path, old)
+    os.rename(temp, path)
+    if os.path.exists(old): shutil.rmtree(old)
+
+def build_item_index(prefs, path, n=10):
+    """
+    Build the item similarity index for prefs in the directory path and
+    return it opened. Anything else in path is replaced.
+    """
+    engine = sparseprefs(transform_prefs(prefs))
+    items = engine.people
+    rank = item_rank(items)
+
+    # Keep at most one entry per other item, like top_matches
+    n = min(n, len(items) - 1)
+    neighbours = np.full((len(items), n), -1, dtype=np.int32)
+    scores = np.zeros((len(items), n))
+
+    for start in range(0, len(items), engine.blocksize):
+        rows = np.arange(start, min(start + engine.blocksize, len(items)))
+        fill_rows(neighbours, scores, rows, engine.rows(rows, 'distance'), rank)
+
+    save_index(path, items, neighbours, scores)
+    return itemindex(path)
@@ -0,0 +1,212 @@
+import random
+import time
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.linalg import svds
+
+from recommendations import sim_cosine, top_matches, load_movie_lens
+from sparseprefs import sparseprefs
+from ranking import top_n
+
+class lshindex:
+    """
+    Approximate nearest neighbour index over the rows of a preference
+    dictionary, using random-projection locality sensitive hashing
+
+    Each person's (or, built over transform_prefs, each item's) ratings are
+    centred on their mean and reduced to dims dimensions with a truncated
+    SVD, which keeps the directions most people vary along and drops the
+    noise of individual ratings. The reduced vectors are projected onto
+    random hyperplanes and the signs of the projections hashed into
+    buckets, one set of buckets per table, so people pointing in similar
+    directions tend to share a bucket. The people sharing a bucket with a
+    query are ranked by their cosine in the reduced space, and only the
+    best limit of them are scored with the exact similarity function.
+
+    The angle between centred ratings is what recommendations.sim_cosine
+    measures, so that is the similarity the index approximates and the
+    default for top_matches. Other similarity functions can be passed, but
+    sim_pearson and sim_distance only look at the items two people share;
+    their best matches are often people with a handful of items in common,
+    who may point anywhere, and the index will mostly miss them.
+
+    Recall goes up with more tables, with probes=1 (which also looks in
+    the buckets one bit away) and with a larger limit, and down with more
+    bits per table, which makes the buckets smaller and the queries faster.
+    By default bits is picked from the number of people so that a query
+    looks at about tables * (bits + 1) / 2 of them.
+
+    On ml-100k (943 users, 11 bits) the defaults gather 21% of the users
+    as candidates and score 10.6% exactly, for a recall@5 of 0.74 against
+    the exact top_matches; 40 tables give 0.87 from 34%. Near neighbours on
+    a catalogue this small are only slightly closer than the rest, so high
+    recall needs a large share of it; recall_report shows the trade-off.
+    """
+    def __init__(self, prefs, tables=20, bits=None, probes=1, dims=50, limit=100, seed=None):
+        engine = sparseprefs(prefs)
+        self.people = engine.people
+        self.person_ids = engine.person_ids
+        rng = np.random.RandomState(seed)
+
+        # Twice as many buckets per table as people, so a bucket holds less
+        # than one person on average and a query looks at a number of
+        # people that grows with log n rather than with n
+        if bits is None: bits = int(np.ceil(np.log2(max(len(self.people), 2)))) + 1
+
+        self.prefs = prefs
+        self.tables = tables
+        self.bits = bits
+        self.probes = probes
+        self.limit = limit
+
+        # Centre each row on its mean rating so the direction of the vector
+        # reflects likes and dislikes rather than how generous a rater is
+        ratings = engine.ratings.tocsr()
+        counts = np.diff(ratings.indptr)
+        means = np.asarray(ratings.sum(axis=1)).ravel() / np.maximum(counts, 1)
+        centred = ratings.data - np.repeat(means, counts)
+
+        # The centred rows scaled to length 1, so that sim_cosine for the
+        # candidates is one sparse product
+        lengths = np.sqrt(np.bincount(np.repeat(np.arange(len(counts)), counts), centred ** 2,
+                                      minlength=len(counts)))
+        scale = 1.0 / np.where(lengths == 0, 1.0, lengths)
+        self.vectors = csr_matrix((centred * np.repeat(scale, counts), ratings.indices, ratings.indptr),
+                                  shape=ratings.shape)
+
+        # Reduced vectors, also scaled to length 1
+        dims = min(dims, min(ratings.shape) - 1)
+        (u, s, vt) = svds(self.vectors, k=dims, v0=rng.standard_normal(min(ratings.shape)))
+        reduced = u * s
+        self.reduced = reduced / np.maximum(np.sqrt((reduced ** 2).sum(axis=1)), 1e-12)[:, np.newaxis]
+
+        # One column of random hyperplanes per bit of every table
+        planes = rng.standard_normal((dims, tables * bits))
+        signs = np.dot(self.reduced, planes) > 0
+
+        # Pack the bits of each table into one integer per row
+        powers = 1 << np.arange(bits, dtype=np.int64)
+        self.signatures = np.dot(signs.reshape(-1, tables, bits), powers)
+
+        self.buckets = []
+        for t in range(tables):
+            buckets = {}
+            for (row, signature) in enumerate(self.signatures[:, t].tolist()):
+                buckets.setdefault(signature, []).append(row)
+            self.buckets.append(buckets)
+
+    def candidates(self, person):
+        """
+        The people sharing at least one bucket with person
+        """
+        return [self.people[i] for i in self.candidate_rows(person)]
+
+    def candidate_rows(self, person):
+        row = self.person_ids[person]
+        found = set()
+
+        for t in range(self.tables):
+            signature = int(self.signatures[row, t])
+            keys = [signature]
+
+            # Multi-probe: also look in the buckets one bit away
+            if self.probes > 0:
+                keys += [signature ^ (1 << b) for b in range(self.bits)]
+
+            for key in keys:
+                found.update(self.buckets[t].get(key, ()))
+
+        found.discard(row)
+        return np.array(sorted(found), dtype=np.intp)
+
+    def shortlist(self, person):
+        """
+        Rows of the candidates that get the exact similarity: the limit
+        closest to person in the reduced space, or all of them
+        """
+        rows = self.candidate_rows(person)
+        if self.limit is None or len(rows) <= self.limit: return rows
+
+        closeness = np.dot(self.reduced[rows], self.reduced[self.person_ids[person]])
+        return rows[np.argsort(-closeness, kind='mergesort')[:self.limit]]
+
+    def top_matches(self, prefs, person, n=5, similarity=sim_cosine):
+        """
+        Approximate version of recommendations.top_matches that only scores
+        the shortlist from the index. sim_cosine is scored from the
+        index's own vectors rather than by calling it.
+        """
+        rows = self.shortlist(person)
+
+        if similarity is sim_cosine:
+            query = self.vectors[self.person_ids[person]]
+            scores = zip(self.vectors[rows].dot(query.T).toarray().ravel().tolist(),
+                         [self.people[i] for i in rows])
+        else:
+            scores = ((similarity(prefs, person, self.people[i]), self.people[i]) for i in rows)
+
+        return top_n(scores, n)
+
+def recall_at_n(prefs, index, n=5, similarity=sim_cosine, sample=100, seed=None):
+    """
+    Compare the index against the exact top_matches for a sample of people.
+
+    An approximate match counts as found if its score is at least the
+    exact n-th best score (less rounding), so ties at the cut-off are not
+    held against the index. Returns the mean recall, the mean fractions of
+    people found in the buckets and scored exactly per query, and the mean
+    query times of both methods.
+    """
+    people = list(prefs)
+    if sample < len(people): people = random.Random(seed).sample(people, sample)
+
+    recall = 0.0
+    candidates = 0.0
+    scored = 0.0
+    exact_time = 0.0
+    approx_time = 0.0
+
+    for person in people:
+        start = time.time()
+        exact = top_matches(prefs, person, n=n, similarity=similarity)
+        exact_time += time.time() - start
+
+        start = time.time()
+        approx = index.top_matches(prefs, person, n=n, similarity=similarity)
+        approx_time += time.time() - start
+
+        cutoff = exact[-1][0]
+        recall += float(len([s for (s, other) in approx if s >= cutoff - 1e-9])) / len(exact)
+        candidates += float(len(index.candidate_rows(person))) / (len(prefs) - 1)
+        scored += float(len(index.shortlist(person))) / (len(prefs) - 1)
+
+    count = len(people)
+    return recall / count, candidates / count, scored / count, exact_time / count, approx_time / count
+
+def recall_report(prefs=None, n=5, similarity=sim_cosine,
+                  settings=((10, None, 1, 100), (20, None, 1, 50), (20, None, 1, 100), (40, None, 1, 100),
+                            (20, 8, 1, 100)),
+                  dims=50, sample=100, seed=0):
+    """
+    Print recall@n of the index against the exact top_matches on ml-100k
+    (or prefs) for a few (tables, bits, probes, limit) settings. bits None
+    is the number the index picks for the size of prefs.
+    """
+    if prefs is None: prefs = load_movie_lens()
+
+    print '%6s %4s %6s %5s %9s %10s %7s %10s %10s' % ('tables', 'bits', 'probes', 'limit', 'recall@%d' % n,
+                                                      'candidates', 'scored', 'exact ms', 'approx ms')
+    results = []
+
+    for (tables, bits, probes, limit) in settings:
+        index = lshindex(prefs, tables=tables, bits=bits, probes=probes, dims=dims, limit=limit, seed=seed)
+        bits = index.bits
+        (recall, candidates, scored, exact_time, approx_time) = recall_at_n(prefs, index, n=n,
+                                                                            similarity=similarity,
+                                                                            sample=sample, seed=seed)
+        print '%6d %4d %6d %5s %9.3f %10.3f %7.3f %10.2f %10.2f' % (tables, bits, probes, limit or '-', recall,
+                                                                   candidates, scored, exact_time * 1000,
+                                                                   approx_time * 1000)
+        results.append((tables, bits, probes, limit, recall, candidates, scored))
+
+    return results
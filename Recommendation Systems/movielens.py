@@ -0,0 +1,113 @@
+import os
+import numpy as np
+
+# One rating from u.data (or any of the u1..u5 / ua / ub splits)
+rating_dtype = np.dtype([('user', '<i4'), ('item', '<i4'), ('rating', '<f4'), ('timestamp', '<i4')])
+
+def parse_ratings(text):
+    """
+    Parse a block of complete tab separated "user item rating timestamp"
+    lines into a typed array
+    """
+    # sep=' ' makes numpy accept any run of whitespace between numbers
+    values = np.fromstring(text, dtype=np.int64, sep=' ').reshape(-1, 4)
+
+    ratings = np.empty(len(values), dtype=rating_dtype)
+    ratings['user'] = values[:, 0]
+    ratings['item'] = values[:, 1]
+    ratings['rating'] = values[:, 2]
+    ratings['timestamp'] = values[:, 3]
+
+    return ratings
+
+def read_ratings(filename, chunksize=1 << 20):
+    """
+    Stream a ratings file in chunks of chunksize bytes into a typed array
+    """
+    chunks = []
+    rest = b''
+
+    with open(filename, 'rb') as f:
+        while True:
+            block = f.read(chunksize)
+            if not block: break
+
+            # Only parse up to the last complete line, the remainder is
+            # carried over to the next chunk
+            block = rest + block
+            end = block.rfind(b'\n') + 1
+            rest = block[end:]
+
+            if end > 0: chunks.append(parse_ratings(block[:end]))
+
+    if rest.strip(): chunks.append(parse_ratings(rest))
+
+    if len(chunks) == 0: return np.empty(0, dtype=rating_dtype)
+
+    return np.concatenate(chunks)
+
+def read_titles(filename):
+    """
+    Read the movie ids and titles from u.item
+    """
+    ids = []
+    titles = []
+
+    with open(filename, 'rb') as f:
+        for line in f:
+            (id, title) = line.split(b'|')[0 : 2]
+            ids.append(int(id))
+            titles.append(title)
+
+    width = max([len(t) for t in titles] + [1])
+    movies = np.empty(len(ids), dtype=[('item', '<i4'), ('title', 'S%d' % width)])
+    movies['item'] = ids
+    movies['title'] = titles
+
+    return movies
+
+def cached(filename, reader):
+    """
+    Load filename through reader, keeping a binary copy of the result next
+    to it. The copy is memory-mapped on later loads and rebuilt whenever the
+    source file is newer than it.
+    """
+    cache = filename + '.npy'
+
+    if os.path.exists(cache) and os.path.getmtime(cache) >= os.path.getmtime(filename):
+        return np.load(cache, mmap_mode='r')
+
+    data = reader(filename)
+
+    # Write to a temporary file first so a crash never leaves half a cache,
+    # named after the process so concurrent loaders don't collide
+    temp = '%s.%d.tmp' % (cache, os.getpid())
+    with open(temp, 'wb') as f:
+        np.save(f, data)
+    os.rename(temp, cache)
+
+    return data
+
+def load_ratings(filename):
+    return cached(filename, read_ratings)
+
+def load_titles(filename):
+    return cached(filename, read_titles)
+
+def to_prefs(ratings, movies=None):
+    """
+    Build the {user: {title: rating}} dictionary used by recommendations.py
+    from a ratings array. Without movies the items are keyed by their id.
+    """
+    if movies is None:
+        titles = {}
+    else:
+        titles = dict(zip(movies['item'].tolist(), movies['title'].tolist()))
+
+    prefs = {}
+
+    for (user, item, rating) in zip(ratings['user'].tolist(), ratings['item'].tolist(), ratings['rating'].tolist()):
+        prefs.setdefault(str(user), {})
+        prefs[str(user)][titles.get(item, str(item))] = rating
+
+    return prefs
@@ -0,0 +1,147 @@
+from math import sqrt
+import numpy as np
+
+class pearsonstream:
+    """
+    Pearson similarity kept up to date from a stream of ratings
+
+    sim_pearson only needs, for each pair of people, the number of items
+    they both rated, the sums and sums of squares of each one's ratings on
+    those items and the sum of the products. These are kept in matrices
+    indexed by person id and updated for every (person, item, rating)
+    event, which only touches the people who rated the same item. A
+    similarity query is then a few lookups and no pass over prefs.
+
+    The matrices are dense, so memory grows with the square of the number
+    of people.
+    """
+    def __init__(self, prefs=None, capacity=64):
+        self.prefs = {}
+        self.people = []
+        self.person_ids = {}
+
+        # Ratings of each item keyed by person id
+        self.raters = {}
+
+        # counts[a, b]: items rated by both a and b
+        # sums[a, b], squares[a, b]: sum and sum of squares of a's ratings
+        # of those items. products[a, b]: sum of the products of the ratings
+        self.counts = np.zeros((capacity, capacity))
+        self.sums = np.zeros((capacity, capacity))
+        self.squares = np.zeros((capacity, capacity))
+        self.products = np.zeros((capacity, capacity))
+
+        if prefs is not None:
+            self.ingest((person, item, rating) for person in prefs for (item, rating) in prefs[person].items())
+
+    def person_id(self, person):
+        if person not in self.person_ids:
+            self.person_ids[person] = len(self.people)
+            self.people.append(person)
+            self.prefs[person] = {}
+
+            # Double the matrices when they are full
+            size = self.counts.shape[0]
+            if len(self.people) > size:
+                for name in ('counts', 'sums', 'squares', 'products'):
+                    grown = np.zeros((size * 2, size * 2))
+                    grown[:size, :size] = getattr(self, name)
+                    setattr(self, name, grown)
+
+        return self.person_ids[person]
+
+    def update(self, person, item, old, new):
+        # Replace person's contribution old with new (either can be None)
+        # in the statistics shared with everyone else who rated item
+        p = self.person_ids[person]
+        raters = self.raters.get(item, {})
+        others = np.array([o for o in raters if o != p], dtype=np.intp)
+        if len(others) == 0: return
+
+        theirs = np.array([raters[o] for o in others])
+        count = 0
+        delta = 0.0
+        delta_sq = 0.0
+
+        if old is not None:
+            count -= 1
+            delta -= old
+            delta_sq -= old * old
+
+        if new is not None:
+            count += 1
+            delta += new
+            delta_sq += new * new
+
+        self.counts[p, others] += count
+        self.counts[others, p] += count
+        self.sums[p, others] += delta
+        self.sums[others, p] += count * theirs
+        self.squares[p, others] += delta_sq
+        self.squares[others, p] += count * theirs * theirs
+        self.products[p, others] += delta * theirs
+        self.products[others, p] += delta * theirs
+
+    def add(self, person, item, rating):
+        """
+        Record a rating, replacing any earlier rating of the same item
+        """
+        p = self.person_id(person)
+        old = self.prefs[person].get(item)
+
+        self.update(person, item, old, rating)
+        self.prefs[person][item] = rating
+        self.raters.setdefault(item, {})[p] = rating
+
+    def remove(self, person, item):
+        p = self.person_ids[person]
+        old = self.prefs[person].pop(item)
+
+        self.update(person, item, old, None)
+        del self.raters[item][p]
+
+    def ingest(self, events):
+        """
+        Apply an iterable of (person, item, rating) events
+        """
+        for (person, item, rating) in events:
+            self.add(person, item, rating)
+
+    def similarity(self, p1, p2):
+        a = self.person_ids[p1]
+        b = self.person_ids[p2]
+
+        if a == b:
+            # The matrices only hold pairs of different people, a person
+            # shares every item they rated with themselves
+            ratings = self.prefs[p1].values()
+            n = float(len(ratings))
+            if n == 0: return 0
+
+            sum1 = sum2 = sum(ratings)
+            sum1Sq = sum2Sq = pSum = sum([r * r for r in ratings])
+        else:
+            # Number of shared items
+            n = self.counts[a, b]
+            if n == 0: return 0
+
+            sum1 = self.sums[a, b]
+            sum2 = self.sums[b, a]
+            sum1Sq = self.squares[a, b]
+            sum2Sq = self.squares[b, a]
+            pSum = self.products[a, b]
+
+        # Same calculation as sim_pearson
+        num = pSum - (sum1 * sum2/n)
+        den = (sum1Sq - pow(sum1, 2) / n) * (sum2Sq - pow(sum2, 2) / n)
+
+        if den <= 0: return 0
+
+        return float(num / sqrt(den))
+
+    def sim_pearson(self, prefs, p1, p2):
+        """
+        Drop-in replacement for recommendations.sim_pearson. prefs is
+        ignored, the scores come from the ingested ratings.
+        """
+        return self.similarity(p1, p2)
@@ -0,0 +1,40 @@
+import heapq
+import numpy as np
+
+def top_n(scores, n=None):
+    """
+    The n highest (score, item) pairs from an iterable, best first
+
+    Gives the same result as sorting the whole list, reversing it and
+    slicing off the first n, so ties go to the greater item. With n set the
+    scores are streamed through a heap of n entries and never built into a
+    full list; items are only compared when two scores are exactly equal.
+    """
+    if n is None: return sorted(scores, reverse=True)
+
+    return heapq.nlargest(n, scores)
+
+def top_row(scores, rank, n):
+    """
+    Indices of the n best scores in an array, highest first. Ties are
+    broken on the item rank so the order matches top_n
+    """
+    if n <= 0: return np.zeros(0, dtype=np.intp)
+
+    if n < len(scores):
+        # Only the scores at or above the n-th best need a full sort
+        candidates = np.argpartition(scores, len(scores) - n)[len(scores) - n:]
+        candidates = np.flatnonzero(scores >= scores[candidates].min())
+    else:
+        candidates = np.arange(len(scores))
+
+    order = np.lexsort((rank[candidates], scores[candidates]))[::-1]
+    return candidates[order[:n]]
+
+def item_rank(items):
+    """
+    The position of each item in sorted order, used to break ties
+    """
+    rank = np.empty(len(items), dtype=np.intp)
+    rank[sorted(range(len(items)), key=lambda i: items[i])] = np.arange(len(items))
+    return rank
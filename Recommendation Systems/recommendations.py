@@ -1,5 +1,9 @@
 from math import sqrt
 from scipy.stats.stats import pearsonr
+import numpy as np
+import movielens
+from sparseprefs import sparseprefs
+from ranking import top_n, top_row, item_rank
 
 # A dictionary of movie critics and their ratings of a small
 # set of movies
@@ -122,13 +126,34 @@ def sim_pearson_mine(prefs, p1, p2):
 
     return num / den
 
+def sim_cosine(prefs, p1, p2):
+    """
+    Cosine of the angle between two people's ratings, each centred on
+    the person's own mean rating, with unrated items counting as 0. Unlike
+    sim_pearson every rating counts and not only the shared ones, so two
+    people who agree on just a couple of items are not a perfect match.
+    """
+    if len(prefs[p1]) == 0 or len(prefs[p2]) == 0: return 0
+
+    mean1 = sum(prefs[p1].values()) / float(len(prefs[p1]))
+    mean2 = sum(prefs[p2].values()) / float(len(prefs[p2]))
+
+    # Only the shared items add to the products
+    num = sum([(prefs[p1][it] - mean1) * (prefs[p2][it] - mean2) for it in prefs[p1] if it in prefs[p2]])
+
+    sum1Sq = sum([pow(r - mean1, 2) for r in prefs[p1].values()])
+    sum2Sq = sum([pow(r - mean2, 2) for r in prefs[p2].values()])
+    den = sqrt(sum1Sq * sum2Sq)
+
+    if den == 0: return 0
+
+    return num / den
+
 def top_matches(prefs, person, n = 5, similarity = sim_pearson):
-    scores = [(similarity(prefs, person, other), other) for other in prefs if other != person]
+    scores = ((similarity(prefs, person, other), other) for other in prefs if other != person)
 
-    # Sort the list so the highest scores appear at the top
-    scores.sort()
-    scores.reverse()
-    return scores[0:n]
+    # Keep the n highest scores, best first
+    return top_n(scores, n)
 
 def calculate_similar_items(prefs, n=10):
     """
@@ -153,10 +178,10 @@ def calculate_similar_items(prefs, n=10):
     return result
 
 
-def get_recommendations(prefs, person, similarity = sim_pearson):
+def get_recommendations(prefs, person, similarity = sim_pearson, n = None):
     """
     Get recommendations for a person by using a weighted average of every
-    other user's rankings
+    other user's rankings. Returns the n best, or all of them if n is None
     """
     totals = {}
     sim_sums = {}
@@ -165,7 +190,6 @@ def get_recommendations(prefs, person, similarity = sim_pearson):
         if other == person: continue
 
         sim = similarity(prefs, person, other)
-        print sim
 
         # ignore scores of 0 or lower
         if sim <= 0: continue
@@ -181,15 +205,60 @@ def get_recommendations(prefs, person, similarity = sim_pearson):
                 sim_sums.setdefault(item, 0)
                 sim_sums[item] += sim
 
-        # Create the normalized list
-        rankings = [(total / sim_sums[item], item) for item, total in totals.items()]
+    # Create the normalized scores
+    rankings = ((total / sim_sums[item], item) for item, total in totals.items())
+
+    # Return the best of them, highest first
+    return top_n(rankings, n)
+
+def recommend_many(prefs, users, n=10, similarity=sim_pearson, engine=None):
+    """
+    Get the top n recommendations for each of users in one pass
+
+    Gives the same rankings as get_recommendations, but the similarity rows
+    for all the users are computed together by the sparse backend and the
+    weighted sums are matrix products over the whole rating matrix. Pass an
+    existing sparseprefs for prefs as engine to reuse it between calls.
+    Returns a list of rankings in the same order as users.
+    """
+    if engine is None: engine = sparseprefs(prefs)
+
+    users = list(users)
+    metrics = {sim_pearson: 'pearson', sim_distance: 'distance'}
+    rank = item_rank(engine.items)
+    results = []
+
+    for start in range(0, len(users), engine.blocksize):
+        block = users[start:start + engine.blocksize]
+        ids = engine.ids(block)
+
+        if similarity in metrics:
+            sims = engine.rows(ids, metrics[similarity])
+        else:
+            sims = np.array([[similarity(prefs, person, other) for other in engine.people] for person in block])
+
+        # ignore the user themselves and scores of 0 or lower
+        sims[np.arange(len(ids)), ids] = 0
+        sims[sims <= 0] = 0
+
+        # similarity * score and sum of similarities for every item at once
+        totals = (engine.ratings.T * sims.T).T
+        sim_sums = (engine.mask.T * sims.T).T
 
-        # Return the sorted list
-        rankings.sort()
-        rankings.reverse()
-        return rankings
+        # only score movies the user hasn't seen yet
+        seen = engine.ratings[ids]
+        seen.eliminate_zeros()
+        sim_sums[seen.nonzero()] = 0
 
-def get_recommended_items(prefs, item_match, user):
+        for (totals_row, sim_sums_row) in zip(totals, sim_sums):
+            candidates = np.flatnonzero(sim_sums_row > 0)
+            scores = totals_row[candidates] / sim_sums_row[candidates]
+            best = top_row(scores, rank[candidates], n)
+            results.append([(float(scores[i]), engine.items[candidates[i]]) for i in best])
+
+    return results
+
+def get_recommended_items(prefs, item_match, user, n = None):
     user_ratings = prefs[user]
     scores = {}
     total_sim = {}
@@ -202,6 +271,9 @@ def get_recommended_items(prefs, item_match, user):
             # Ignore if this user has already rated this item
             if item2 in user_ratings: continue
 
+            # Neighbours with no similarity add nothing
+            if similarity == 0: continue
+
             # Weighted sum of rating times similarity
             scores.setdefault(item2, 0)
             scores[item2] += similarity * rating
@@ -211,13 +283,12 @@ def get_recommended_items(prefs, item_match, user):
             total_sim[item2] += similarity
 
 
-    # Divide each total score by total weighting to get an average
-    rankings = [(score / total_sim[item], item) for item, score in scores.items()]
+    # Divide each total score by total weighting to get an average,
+    # skipping items whose similarities cancel out
+    rankings = ((score / total_sim[item], item) for item, score in scores.items() if total_sim[item] != 0)
 
-    # Return the rankings from highest to lowest
-    rankings.sort()
-    rankings.reverse()
-    return rankings
+    # Return the best n rankings (all if n is None) from highest to lowest
+    return top_n(rankings, n)
 
 def transform_prefs(prefs):
     """
@@ -237,19 +308,11 @@ def transform_prefs(prefs):
 def load_movie_lens(path = 'ml-100k'):
     """
     Load the GroupLens movie dataset
-    """
-    movies = {}
-
-    # Get movie titles
-    for line in open(path + '/u.item'):
-        (id, title) = line.split('|')[0 : 2]
-        movies[id] = title
 
-    # Load data
-    prefs = {}
-    for line in open(path + '/u.data'):
-        (user, movieid, rating, ts) = line.split('\t')
-        prefs.setdefault(user, {})
-        prefs[user][movies[movieid]] = float(rating)
+    The ratings and titles are cached in binary form next to the dataset
+    on first load (see movielens.py), later loads memory-map the cache
+    """
+    ratings = movielens.load_ratings(path + '/u.data')
+    movies = movielens.load_titles(path + '/u.item')
 
-    return prefs
\ No newline at end of file
+    return movielens.to_prefs(ratings, movies)
\ No newline at end of file
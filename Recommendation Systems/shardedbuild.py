@@ -0,0 +1,143 @@
+import os
+import pickle
+import shutil
+import tempfile
+from multiprocessing import Pool, TimeoutError
+import numpy as np
+
+from recommendations import transform_prefs, top_matches, sim_distance, sim_pearson
+from sparseprefs import sparseprefs
+from ranking import top_row, item_rank
+
+# State shared by the worker processes, set up by init_worker
+worker = {}
+
+def init_worker(item_prefs, n, similarity, checkpoint_dir, blocksize):
+    worker['item_prefs'] = item_prefs
+    worker['n'] = n
+    worker['similarity'] = similarity
+    worker['checkpoint_dir'] = checkpoint_dir
+
+    metrics = {sim_distance: 'distance', sim_pearson: 'pearson'}
+    worker['metric'] = metrics.get(similarity)
+
+    if worker['metric'] is not None:
+        # Small row blocks keep the dense intermediate matrices bounded
+        # however many items there are
+        engine = sparseprefs(item_prefs, blocksize=blocksize)
+        worker['engine'] = engine
+        worker['rank'] = item_rank(engine.people)
+
+def shard_path(checkpoint_dir, shard):
+    return os.path.join(checkpoint_dir, 'shard-%05d.pickle' % shard)
+
+def build_shard(args):
+    """
+    Compute the neighbours of one shard of items and checkpoint them
+    """
+    (shard, items) = args
+    item_prefs = worker['item_prefs']
+    n = worker['n']
+    result = {}
+
+    if worker['metric'] is None:
+        for item in items:
+            result[item] = top_matches(item_prefs, item, n=n, similarity=worker['similarity'])
+    else:
+        engine = worker['engine']
+        rank = worker['rank']
+        ids = engine.ids(items)
+
+        for start in range(0, len(ids), engine.blocksize):
+            block = ids[start:start + engine.blocksize]
+
+            for (row, scores) in zip(block, engine.rows(block, worker['metric'])):
+                # Same selection as top_matches: everything but the item itself
+                scores[row] = -np.inf
+                best = top_row(scores, rank, min(n, len(scores) - 1))
+                result[engine.people[row]] = [(float(scores[i]), engine.people[i]) for i in best]
+
+    # Write to a temporary file and rename so a shard is either fully
+    # checkpointed or not at all
+    path = shard_path(worker['checkpoint_dir'], shard)
+    with open(path + '.tmp', 'wb') as f:
+        pickle.dump(result, f, pickle.HIGHEST_PROTOCOL)
+    os.rename(path + '.tmp', path)
+
+    return shard
+
+def calculate_similar_items_sharded(prefs, n=10, shards=64, processes=None, checkpoint_dir=None,
+                                    similarity=sim_distance, blocksize=64):
+    """
+    Build the same {item: [(score, item2), ...]} dataset as
+    calculate_similar_items, split into shards that are computed in a
+    process pool.
+
+    Each finished shard is saved in checkpoint_dir, and running again with
+    the same checkpoint_dir only computes the shards that are missing, so an
+    interrupted build picks up where it stopped. Without a checkpoint_dir a
+    temporary one is used and removed afterwards.
+    """
+    item_prefs = transform_prefs(prefs)
+    items = sorted(item_prefs)
+
+    temporary = checkpoint_dir is None
+    if temporary: checkpoint_dir = tempfile.mkdtemp()
+    if not os.path.isdir(checkpoint_dir): os.makedirs(checkpoint_dir)
+
+    # The manifest records how the items were split so a resumed build
+    # can't mix shards from different runs
+    manifest = {'n': n, 'shards': shards, 'similarity': similarity.__name__, 'items': items}
+    manifest_path = os.path.join(checkpoint_dir, 'manifest.pickle')
+
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'rb') as f:
+            if pickle.load(f) != manifest:
+                raise ValueError('%s holds a build with different items or settings' % checkpoint_dir)
+    else:
+        with open(manifest_path, 'wb') as f:
+            pickle.dump(manifest, f, pickle.HIGHEST_PROTOCOL)
+
+    size = (len(items) + shards - 1) // shards
+    pending = [(shard, items[shard * size:(shard + 1) * size]) for shard in range(shards)
+               if not os.path.exists(shard_path(checkpoint_dir, shard))]
+
+    if pending:
+        pool = Pool(processes, initializer=init_worker,
+                    initargs=(item_prefs, n, similarity, checkpoint_dir, blocksize))
+        try:
+            done = shards - len(pending)
+            results = pool.imap_unordered(build_shard, pending)
+
+            for i in range(len(pending)):
+                # Wait with a timeout: in Python 2 a wait without one can't
+                # be interrupted with Ctrl-C
+                while True:
+                    try:
+                        results.next(1)
+                        break
+                    except TimeoutError:
+                        pass
+
+                # Status updates for large datasets
+                done += 1
+                print "%d / %d shards" % (done, shards)
+        except:
+            # Stop the shards still queued rather than letting them all run
+            # before the error gets through; finished shards stay on disk
+            pool.terminate()
+            pool.join()
+            raise
+
+        pool.close()
+        pool.join()
+
+    # Merge the shards into one result
+    result = {}
+    for shard in range(shards):
+        with open(shard_path(checkpoint_dir, shard), 'rb') as f:
+            result.update(pickle.load(f))
+
+    if temporary: shutil.rmtree(checkpoint_dir)
+
+    return result
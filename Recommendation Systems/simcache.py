@@ -0,0 +1,104 @@
+from collections import OrderedDict
+
+class similaritycache:
+    """
+    A bounded LRU cache of similarity scores for one preference dictionary
+
+    Scores are keyed by similarity function and pair of people, so the same
+    cache can hold sim_pearson, sim_pearson_mine, sim_distance and
+    sim_cosine scores side by side. All of them are symmetric, so by
+    default a pair is stored once whichever way round it is asked for;
+    pass symmetric=False to cache functions that aren't. wrap() returns a function with the usual
+    similarity(prefs, p1, p2) signature that goes through the cache, e.g.
+
+        cache = similaritycache()
+        get_recommendations(prefs, 'Toby', similarity=cache.wrap(sim_pearson))
+
+    When someone's ratings change, only the scores involving them are
+    dropped; use set_rating or call invalidate yourself.
+    """
+    def __init__(self, maxsize=100000, symmetric=True):
+        self.maxsize = maxsize
+        self.symmetric = symmetric
+        self.entries = OrderedDict()
+
+        # Keys of the cached scores each person takes part in
+        self.rows = {}
+
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, similarity, prefs, p1, p2):
+        key = (similarity, p1, p2)
+        if self.symmetric and p2 < p1: key = (similarity, p2, p1)
+
+        if key in self.entries:
+            self.hits += 1
+
+            # Move the entry to the most recently used end
+            score = self.entries.pop(key)
+            self.entries[key] = score
+            return score
+
+        self.misses += 1
+        score = similarity(prefs, p1, p2)
+        self.entries[key] = score
+        self.rows.setdefault(p1, set()).add(key)
+        self.rows.setdefault(p2, set()).add(key)
+
+        # Evict the least recently used scores
+        while len(self.entries) > self.maxsize:
+            (old, _) = self.entries.popitem(last=False)
+            self.forget(old)
+
+        return score
+
+    def forget(self, key):
+        # Remove a key from the rows of both people in it
+        for person in key[1:]:
+            row = self.rows.get(person)
+            if row is None: continue
+
+            row.discard(key)
+            if not row: del self.rows[person]
+
+    def wrap(self, similarity):
+        def cached(prefs, p1, p2):
+            return self.get(similarity, prefs, p1, p2)
+
+        return cached
+
+    def invalidate(self, person):
+        """
+        Drop every cached score involving person
+        """
+        for key in list(self.rows.get(person, ())):
+            del self.entries[key]
+            self.forget(key)
+
+    def set_rating(self, prefs, person, item, rating):
+        """
+        Change a rating in prefs and invalidate the scores it affects
+        """
+        prefs.setdefault(person, {})
+        prefs[person][item] = rating
+        self.invalidate(person)
+
+    def remove_rating(self, prefs, person, item):
+        del prefs[person][item]
+        self.invalidate(person)
+
+    def clear(self):
+        self.entries.clear()
+        self.rows.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self.entries),
+                'maxsize': self.maxsize,
+                'hit_rate': float(self.hits) / lookups if lookups else 0.0}
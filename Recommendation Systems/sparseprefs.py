@@ -0,0 +1,126 @@
+import numpy as np
+from scipy.sparse import csr_matrix
+
+class sparseprefs:
+    """
+    A sparse matrix view of a preference dictionary
+
+    Users and items are interned to integer ids and the ratings are kept in
+    a CSR matrix with one row per user, so that similarity scores for every
+    pair of users can be computed with a handful of matrix products instead
+    of one dictionary intersection per pair.
+    """
+    def __init__(self, prefs, blocksize=1024):
+        self.prefs = prefs
+        self.blocksize = blocksize
+
+        # Intern people and items to integer ids
+        self.people = list(prefs)
+        self.person_ids = dict((p, i) for (i, p) in enumerate(self.people))
+        self.items = []
+        self.item_ids = {}
+
+        rows = []
+        cols = []
+        ratings = []
+
+        for (row, person) in enumerate(self.people):
+            for (item, rating) in prefs[person].items():
+                if item not in self.item_ids:
+                    self.item_ids[item] = len(self.items)
+                    self.items.append(item)
+
+                rows.append(row)
+                cols.append(self.item_ids[item])
+                ratings.append(rating)
+
+        shape = (len(self.people), len(self.items))
+
+        # The ratings themselves and a mask of which cells hold a rating.
+        # The mask is built separately so that explicit ratings of 0 still
+        # count as rated
+        self.ratings = csr_matrix((np.array(ratings, dtype=np.float64), (rows, cols)), shape=shape)
+        self.mask = csr_matrix((np.ones(len(ratings)), (rows, cols)), shape=shape)
+        self.squares = self.ratings.multiply(self.ratings).tocsr()
+
+        # Cache of full similarity matrices keyed by metric name
+        self.matrices = {}
+
+    def ids(self, people):
+        return np.array([self.person_ids[p] for p in people], dtype=np.intp)
+
+    def rows(self, ids, metric='pearson'):
+        """
+        Similarity of each person in ids against every person, as a dense
+        array with one row per id
+        """
+        ids = np.asarray(ids, dtype=np.intp)
+        result = np.zeros((len(ids), len(self.people)))
+
+        # Work in blocks of rows to keep the intermediate matrices small
+        for start in range(0, len(ids), self.blocksize):
+            block = ids[start:start + self.blocksize]
+            result[start:start + len(block)] = self.block(block, metric)
+
+        return result
+
+    def block(self, ids, metric):
+        r1 = self.ratings[ids]
+        m1 = self.mask[ids]
+
+        # Number of shared items and sums over the shared items for
+        # every pair at once
+        n = (m1 * self.mask.T).toarray()
+        sum1 = (r1 * self.mask.T).toarray()
+        sum2 = (m1 * self.ratings.T).toarray()
+        sum1_sq = (self.squares[ids] * self.mask.T).toarray()
+        sum2_sq = (m1 * self.squares.T).toarray()
+        p_sum = (r1 * self.ratings.T).toarray()
+
+        shared = n > 0
+        n[~shared] = 1.0
+
+        if metric == 'pearson':
+            # Same formula as sim_pearson, evaluated for the whole block
+            num = p_sum - (sum1 * sum2 / n)
+            den = (sum1_sq - np.power(sum1, 2) / n) * (sum2_sq - np.power(sum2, 2) / n)
+            den = np.sqrt(np.clip(den, 0, None))
+
+            valid = shared & (den != 0)
+            scores = np.zeros(n.shape)
+            scores[valid] = num[valid] / den[valid]
+        elif metric == 'distance':
+            # sum((a - b)^2) expands to sum(a^2) + sum(b^2) - 2 * sum(a * b)
+            sum_of_squares = np.clip(sum1_sq + sum2_sq - 2 * p_sum, 0, None)
+            scores = np.where(shared, 1.0 / (1 + np.sqrt(sum_of_squares)), 0.0)
+        else:
+            raise ValueError('Unknown similarity metric: %s' % metric)
+
+        return scores
+
+    def matrix(self, metric='pearson'):
+        """
+        The similarity matrix for every pair of people, computed on first use
+        """
+        if metric not in self.matrices:
+            self.matrices[metric] = self.rows(np.arange(len(self.people)), metric)
+
+        return self.matrices[metric]
+
+    def similarity(self, prefs, p1, p2, metric):
+        if prefs is not self.prefs:
+            raise ValueError('sparseprefs was built from a different preference dictionary')
+
+        return float(self.matrix(metric)[self.person_ids[p1], self.person_ids[p2]])
+
+    def sim_pearson(self, prefs, p1, p2):
+        """
+        Drop-in replacement for recommendations.sim_pearson
+        """
+        return self.similarity(prefs, p1, p2, 'pearson')
+
+    def sim_distance(self, prefs, p1, p2):
+        """
+        Drop-in replacement for recommendations.sim_distance
+        """
+        return self.similarity(prefs, p1, p2, 'distance')